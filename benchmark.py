@@ -0,0 +1,366 @@
+# benchmark.py
+# Offline load generator for Aschat. Starts main.py on a local port, connects simulated
+# python-socketio clients and reports end-to-end delivery latency, server CPU and RSS, and
+# delivered messages per second for each scenario:
+#   connect_storm  every client connects at once
+#   steady_chat    random clients send chat messages at a fixed total rate
+#   moderation     a host toggles chat-disabled and mutes/unmutes users
+#   video_sync     a host sends periodic host_video_control syncs
+#
+# Usage:
+#   pip install -r requirements-bench.txt
+#   python benchmark.py --clients 1000 --duration 20
+#   python benchmark.py --scenario steady_chat --chat-rate 200 --json
+#
+# Everything runs on one Linux box: latency is measured against the sender's clock, and
+# server CPU/RSS come from /proc. The clients share one asyncio loop, so with very many
+# clients their own processing shows up in the latency; run on a machine with spare cores.
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import socketio
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+SCENARIOS = ('connect_storm', 'steady_chat', 'moderation', 'video_sync')
+BENCH_PASSWORD = 'benchmark-' + secrets.token_hex(8)
+# The server's per-connection limits would otherwise throttle the simulated host and senders
+BENCH_RATE_LIMITS = {event: [10000, 10000] for event in (
+    'message', 'authenticate_host', 'toggle_mute_user', 'toggle_chat_enabled', 'host_video_control')}
+CONNECT_CONCURRENCY = 200 # Outside the connect storm, clients join in waves of this size
+DRAIN_SECONDS = 2.0 # Wait after the last send for deliveries still in flight
+
+# --- Server Process ---
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(port, log_file, data_dir):
+    env = dict(os.environ,
+               PORT=str(port),
+               DATA_DIR=data_dir, # Keeps bench rooms' chat logs and uploads out of the repo
+               HOST_PASSWORD=BENCH_PASSWORD,
+               LOG_LEVEL='warning',
+               RATE_LIMITS=json.dumps(BENCH_RATE_LIMITS))
+    env.pop('REDIS_URL', None) # Always the in-memory backend, so runs are comparable
+    server = subprocess.Popen([sys.executable, MAIN_PATH], env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'Server exited with code {server.returncode}; see {log_file.name}')
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=1).read()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f'Server did not start listening on port {port}; see {log_file.name}')
+
+class ProcessStats:
+    # CPU time and resident memory of a process, read from /proc (Linux only)
+    def __init__(self, pid):
+        self.pid = pid
+        self.ticks = os.sysconf('SC_CLK_TCK')
+
+    def cpu_seconds(self):
+        with open(f'/proc/{self.pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / self.ticks # utime + stime
+
+    def rss_bytes(self):
+        with open(f'/proc/{self.pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+async def watch_rss(stats, peak):
+    while True:
+        peak[0] = max(peak[0], stats.rss_bytes())
+        await asyncio.sleep(0.25)
+
+# --- Simulated Clients ---
+
+class Recorder:
+    # Latencies (seconds) and delivery counts for one scenario
+    def __init__(self):
+        self.latencies = []
+        self.delivered = 0
+        self.sent = 0
+        self.marks = {} # event -> time the host last triggered it
+
+    def record(self, sent_at):
+        self.latencies.append(time.time() - sent_at)
+        self.delivered += 1
+
+def chat_text(sent_at):
+    return f'bench {sent_at:.6f}'
+
+def chat_sent_at(data):
+    text = data.get('message', '')
+    return float(text[6:]) if text.startswith('bench ') else None
+
+def make_client(recorder):
+    sio = socketio.AsyncClient(reconnection=False)
+
+    @sio.on('new_message')
+    def on_new_message(data):
+        sent_at = chat_sent_at(data)
+        if sent_at is not None:
+            recorder.record(sent_at)
+
+    @sio.on('new_messages')
+    def on_new_messages(data):
+        for message in data['messages']:
+            on_new_message(message)
+
+    @sio.on('sync_video_playback')
+    def on_sync(data):
+        if 'server_time' in data: # The host's sent_at, accepted as the playback anchor
+            recorder.record(data['server_time'])
+
+    @sio.on('update_chat_status')
+    def on_chat_status(data):
+        if 'update_chat_status' in recorder.marks:
+            recorder.record(recorder.marks['update_chat_status'])
+
+    @sio.on('you_are_muted')
+    @sio.on('you_are_unmuted')
+    def on_mute(data):
+        if 'mute' in recorder.marks:
+            recorder.record(recorder.marks['mute'])
+
+    return sio
+
+async def connect_client(sio, url, durations=None):
+    started = time.perf_counter()
+    await sio.connect(url, transports=['websocket'], wait_timeout=60)
+    if durations is not None:
+        durations.append(time.perf_counter() - started)
+
+async def connect_clients(count, url, recorder):
+    clients = [make_client(recorder) for _ in range(count)]
+    for start in range(0, count, CONNECT_CONCURRENCY):
+        await asyncio.gather(*(connect_client(sio, url) for sio in clients[start:start + CONNECT_CONCURRENCY]))
+    return clients
+
+async def disconnect_clients(clients):
+    await asyncio.gather(*(sio.disconnect() for sio in clients), return_exceptions=True)
+
+async def authenticate_host(sio):
+    authenticated = asyncio.get_running_loop().create_future()
+    sio.on('host_authenticated', lambda data: authenticated.done() or authenticated.set_result(data))
+    await sio.emit('authenticate_host', {'password': BENCH_PASSWORD})
+    result = await asyncio.wait_for(authenticated, 10)
+    if not result.get('success'):
+        raise RuntimeError('Host authentication failed')
+
+# --- Scenarios ---
+
+def room_url(base_url, scenario):
+    # A fresh room per run keeps scenarios from seeing each other's traffic
+    return f'{base_url}?room=bench-{scenario}-{secrets.token_hex(4)}'
+
+async def run_connect_storm(base_url, args, recorder):
+    url = room_url(base_url, 'connect_storm')
+    clients = [make_client(recorder) for _ in range(args.clients)]
+    durations = []
+    results = await asyncio.gather(*(connect_client(sio, url, durations) for sio in clients), return_exceptions=True)
+    failures = sum(1 for result in results if isinstance(result, Exception))
+    # Here the latencies are connect times, and 'delivered' counts established connections
+    recorder.latencies = durations
+    recorder.sent = args.clients
+    recorder.delivered = len(durations)
+    await asyncio.sleep(DRAIN_SECONDS) # Let the presence batch go out while we still measure
+    await disconnect_clients(clients)
+    return {'connect_failures': failures}
+
+async def run_steady_chat(base_url, args, recorder):
+    clients = await connect_clients(args.clients, room_url(base_url, 'steady_chat'), recorder)
+    interval = 1.0 / args.chat_rate
+    deadline = time.monotonic() + args.duration
+    sender = 0
+    while time.monotonic() < deadline:
+        await clients[sender].emit('message', {'username': f'bench{sender}', 'message': chat_text(time.time())})
+        recorder.sent += 1
+        sender = (sender + 7919) % len(clients) # Spread senders across the room
+        await asyncio.sleep(interval)
+    await asyncio.sleep(DRAIN_SECONDS)
+    await disconnect_clients(clients)
+    return {'expected_deliveries': recorder.sent * len(clients)}
+
+async def run_moderation(base_url, args, recorder):
+    clients = await connect_clients(args.clients, room_url(base_url, 'moderation'), recorder)
+    host, viewers = clients[0], clients[1:]
+    await authenticate_host(host)
+    deadline = time.monotonic() + args.duration
+    chat_enabled = True
+    toggles = mutes = 0
+    while time.monotonic() < deadline:
+        # One room-wide toggle, then one personal mute toggle aimed at a single viewer
+        chat_enabled = not chat_enabled
+        recorder.marks['update_chat_status'] = time.time()
+        await host.emit('toggle_chat_enabled', {'enabled': chat_enabled})
+        toggles += 1
+        await asyncio.sleep(args.control_interval / 2)
+        if viewers:
+            target = viewers[mutes % len(viewers)]
+            recorder.marks['mute'] = time.time()
+            await host.emit('toggle_mute_user', {'target_sid': target.get_sid()})
+            mutes += 1
+        await asyncio.sleep(args.control_interval / 2)
+    recorder.sent = toggles + mutes
+    await asyncio.sleep(DRAIN_SECONDS)
+    await disconnect_clients(clients)
+    return {'chat_toggles': toggles, 'mute_toggles': mutes, 'expected_deliveries': toggles * len(clients) + mutes}
+
+async def run_video_sync(base_url, args, recorder):
+    clients = await connect_clients(args.clients, room_url(base_url, 'video_sync'), recorder)
+    host = clients[0]
+    await authenticate_host(host)
+    deadline = time.monotonic() + args.duration
+    position = 0.0
+    while time.monotonic() < deadline:
+        action = 'seek' if recorder.sent % 5 == 4 else 'play'
+        await host.emit('host_video_control', {'action': action, 'time': position, 'rate': 1.0, 'sent_at': time.time()})
+        recorder.sent += 1
+        position += args.control_interval
+        await asyncio.sleep(args.control_interval)
+    await asyncio.sleep(DRAIN_SECONDS)
+    await disconnect_clients(clients)
+    return {'expected_deliveries': recorder.sent * (len(clients) - 1)} # Not echoed to the host
+
+SCENARIO_RUNNERS = {
+    'connect_storm': run_connect_storm,
+    'steady_chat': run_steady_chat,
+    'moderation': run_moderation,
+    'video_sync': run_video_sync,
+}
+
+# --- Reporting ---
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+async def run_scenario(name, base_url, args, server_stats):
+    recorder = Recorder()
+    peak_rss = [0]
+    watcher = asyncio.create_task(watch_rss(server_stats, peak_rss)) if server_stats else None
+    cpu_before = server_stats.cpu_seconds() if server_stats else None
+    started = time.perf_counter()
+    extra = await SCENARIO_RUNNERS[name](base_url, args, recorder)
+    elapsed = time.perf_counter() - started
+    if watcher:
+        watcher.cancel()
+
+    latencies = sorted(recorder.latencies)
+    ms = lambda value: round(value * 1000, 2) if value is not None else None
+    result = {
+        'scenario': name,
+        'clients': args.clients,
+        'seconds': round(elapsed, 2),
+        'sent': recorder.sent,
+        'delivered': recorder.delivered,
+        'delivered_per_second': round(recorder.delivered / elapsed, 1),
+        'latency_ms': {
+            'p50': ms(percentile(latencies, 0.50)),
+            'p90': ms(percentile(latencies, 0.90)),
+            'p99': ms(percentile(latencies, 0.99)),
+            'max': ms(latencies[-1] if latencies else None),
+        },
+    }
+    if server_stats:
+        result['server_cpu_percent'] = round(100 * (server_stats.cpu_seconds() - cpu_before) / elapsed, 1)
+        result['server_peak_rss_mb'] = round(peak_rss[0] / (1024 * 1024), 1)
+    result.update(extra)
+    return result
+
+def print_table(results):
+    columns = ('scenario', 'clients', 'sent', 'delivered', 'msg/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'cpu %', 'rss MB')
+    rows = [[
+        r['scenario'], r['clients'], r['sent'], r['delivered'], r['delivered_per_second'],
+        r['latency_ms']['p50'], r['latency_ms']['p90'], r['latency_ms']['p99'], r['latency_ms']['max'],
+        r.get('server_cpu_percent', '-'), r.get('server_peak_rss_mb', '-'),
+    ] for r in results]
+    widths = [max(len(str(value)) for value in column) for column in zip(columns, *rows)]
+    for row in [columns] + rows:
+        print('  '.join(str(value).rjust(width) for value, width in zip(row, widths)))
+    for r in results:
+        notes = {key: value for key, value in r.items() if key not in (
+            'scenario', 'clients', 'seconds', 'sent', 'delivered', 'delivered_per_second', 'latency_ms',
+            'server_cpu_percent', 'server_peak_rss_mb')}
+        if notes:
+            print(f"{r['scenario']}: " + ', '.join(f'{key}={value}' for key, value in notes.items()))
+
+def raise_fd_limit(clients):
+    # Every client holds a socket, and so does the server for each of them
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = clients * 2 + 1024
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+async def main(args):
+    scenarios = SCENARIOS if args.scenario == 'all' else (args.scenario,)
+    results = []
+    for name in scenarios:
+        results.append(await run_scenario(name, args.base_url, args, args.server_stats))
+        if not args.json:
+            print(f"{name}: done in {results[-1]['seconds']}s", file=sys.stderr)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Socket.IO load benchmark for Aschat')
+    parser.add_argument('--scenario', choices=SCENARIOS + ('all',), default='all')
+    parser.add_argument('--clients', type=int, default=1000, help='Simulated clients per scenario')
+    parser.add_argument('--duration', type=float, default=20.0, help='Seconds of load per scenario')
+    parser.add_argument('--chat-rate', type=float, default=50.0, help='Chat messages per second (steady_chat)')
+    parser.add_argument('--control-interval', type=float, default=1.0,
+                        help='Seconds between host actions (moderation, video_sync)')
+    parser.add_argument('--url', help='Benchmark an already running server instead of starting main.py '
+                                      '(its HOST_PASSWORD and RATE_LIMITS must allow the host scenarios)')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+    if args.clients < 2:
+        parser.error('--clients must be at least 2')
+
+    raise_fd_limit(args.clients)
+    server = None
+    args.server_stats = None
+    if args.url:
+        args.base_url = args.url.rstrip('/')
+    else:
+        port = free_port()
+        log_file = tempfile.NamedTemporaryFile(prefix='aschat-bench-', suffix='.log', delete=False)
+        data_dir = tempfile.TemporaryDirectory(prefix='aschat-bench-')
+        server = start_server(port, log_file, data_dir.name)
+        args.base_url = f'http://127.0.0.1:{port}'
+        args.server_stats = ProcessStats(server.pid)
+    try:
+        asyncio.run(main(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+                server.wait()
+            data_dir.cleanup()
@@ -1,11 +1,38 @@
 # main.py
-from flask import Flask, Response, request, send_from_directory
+from flask import Flask, Response, request
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import os
+import sys
 import datetime
 import json
 import re
 import shutil # For clearing uploads directory
+import gzip
+import hashlib
+import time
+import secrets
+import struct
+import io
+import mimetypes
+import fcntl
+import mmap
+import bisect
+import functools
+import random
+import atexit
+import marshal
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+try:
+    import brotli # Optional: enables Brotli-compressed responses when installed
+except ImportError:
+    brotli = None
+
+try:
+    import redis # Optional: only needed when REDIS_URL is set (multi-worker deployments)
+except ImportError:
+    redis = None
 
 app = Flask(__name__)
 
@@ -22,35 +49,596 @@ HOST_PASSWORD = os.environ.get('HOST_PASSWORD', 'my_secret_host_key_CHANGE_THIS_
 # Adjust SocketIO for production deployment (e.g., eventlet/gevent, message queues)
 # For simple deployments, you might not need an explicit message_queue if sticky sessions are supported.
 # For scaled deployments, a message queue (like Redis) is essential.
-# Example with Redis:
-# socketio = SocketIO(app, message_queue=os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
-socketio = SocketIO(app) # For basic deployment without explicit message queue config
+# Setting REDIS_URL (e.g. redis://localhost:6379/0) makes Redis both the Socket.IO message queue
+# and the shared state backend below, so several workers or nodes can serve the same room.
+REDIS_URL = os.environ.get('REDIS_URL')
+if REDIS_URL:
+    socketio = SocketIO(app, message_queue=REDIS_URL)
+else:
+    socketio = SocketIO(app) # For basic deployment without explicit message queue config
+
+# --- Logging ---
+# Handlers never write to stdout themselves: log_event() drops a record into a bounded queue
+# and a writer on a real OS thread (not a green one, so a slow or full stdout pipe never
+# stalls the event loop) writes the queue out as JSON lines, one write per batch. Each event
+# has a level (LOG_LEVEL sets the threshold), high-volume events are sampled, and records
+# that find the queue full are counted and reported instead of blocking the handler.
+# LOG_EVENT_LEVELS and LOG_SAMPLE_RATES (JSON objects) override the defaults below.
+try:
+    from eventlet.patcher import original as unpatched_module
+except ImportError:
+    unpatched_module = __import__
+real_threading = unpatched_module('threading')
+real_time = unpatched_module('time')
+
+LOG_LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+LOG_LEVEL = LOG_LEVELS.get(os.environ.get('LOG_LEVEL', 'info').lower(), LOG_LEVELS['info'])
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+LOG_FLUSH_INTERVAL = 0.1 # Seconds between writer batches
+EVENT_LOG_LEVELS = {
+    'connect': 'info',
+    'disconnect': 'info',
+    'message': 'info',
+    'video_control': 'debug',
+    'host_authenticated': 'info',
+    'host_authentication_failed': 'warning',
+    'user_muted': 'info',
+    'user_unmuted': 'info',
+    'video_share_started': 'info',
+    'room_freed': 'info',
+    'upload_aborted': 'warning',
+    'faststart_skipped': 'info',
+    'faststart_failed': 'warning',
+    'metadata_unreadable': 'warning',
+    'delete_failed': 'error',
+    'chat_log_truncated': 'warning',
+    'chat_log_unreadable': 'error',
+    'slow_event': 'warning',
+    'profile_started': 'info',
+}
+EVENT_LOG_LEVELS.update(json.loads(os.environ.get('LOG_EVENT_LEVELS', '{}')))
+LOG_SAMPLE_RATES = {'message': 0.1, 'video_control': 0.05} # Fraction of these events that is logged
+LOG_SAMPLE_RATES.update(json.loads(os.environ.get('LOG_SAMPLE_RATES', '{}')))
+
+log_queue = deque()
+log_stats = {'queued': 0, 'written': 0, 'dropped': 0, 'dropped_reported': 0}
+log_writer_started = False
+
+def log_event(event, **fields):
+    global log_writer_started
+    level = EVENT_LOG_LEVELS.get(event, 'info')
+    if LOG_LEVELS.get(level, LOG_LEVELS['info']) < LOG_LEVEL:
+        return
+    sample_rate = LOG_SAMPLE_RATES.get(event)
+    if sample_rate is not None and random.random() >= sample_rate:
+        return
+    if len(log_queue) >= LOG_QUEUE_SIZE:
+        log_stats['dropped'] += 1
+        count_metric('aschat_log_records_dropped_total')
+        return
+    # Encoded by the writer, so the handler only pays for building the dict
+    record = {'ts': round(time.time(), 3), 'level': level, 'event': event}
+    record.update(fields)
+    if sample_rate is not None:
+        record['sample_rate'] = sample_rate
+    log_queue.append(record)
+    log_stats['queued'] += 1
+    if not log_writer_started:
+        log_writer_started = True
+        real_threading.Thread(target=write_logs_forever, daemon=True).start()
+
+def write_pending_logs():
+    lines = []
+    while log_queue:
+        lines.append(json.dumps(log_queue.popleft(), default=str))
+    dropped = log_stats['dropped'] - log_stats['dropped_reported']
+    if dropped:
+        lines.append(json.dumps({'ts': round(time.time(), 3), 'level': 'warning', 'event': 'log_dropped', 'count': dropped}))
+        log_stats['dropped_reported'] = log_stats['dropped']
+    if not lines:
+        return
+    try:
+        sys.stdout.write('\n'.join(lines) + '\n')
+        sys.stdout.flush()
+        log_stats['written'] += len(lines)
+    except (OSError, ValueError):
+        pass # Nowhere left to report it
+
+def write_logs_forever():
+    while True:
+        real_time.sleep(LOG_FLUSH_INTERVAL)
+        write_pending_logs()
+
+atexit.register(write_pending_logs)
+
+# --- Metrics ---
+# Counters and histograms live in plain dicts keyed by (name, labels). Each worker runs its
+# handlers on one event loop, so updates need no locks, and recording one costs a dict
+# lookup and an add. GET /metrics renders them, plus gauges computed at scrape time,
+# in the Prometheus text format. With several workers each one reports its own numbers.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+RECIPIENT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+UPLOAD_DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800)
+THROUGHPUT_BUCKETS = tuple(2 ** power * 1024 * 1024 for power in range(-2, 11)) # 256 KiB/s .. 1 GiB/s
+
+METRIC_HELP = {
+    'aschat_socketio_events_total': ('counter', 'Socket.IO events handled, by event'),
+    'aschat_socketio_event_errors_total': ('counter', 'Socket.IO handlers that raised, by event'),
+    'aschat_socketio_event_duration_seconds': ('histogram', 'Socket.IO handler latency, by event'),
+    'aschat_broadcasts_total': ('counter', 'Room broadcasts sent, by event'),
+    'aschat_broadcast_recipients': ('histogram', 'Local recipients per room broadcast, by event'),
+    'aschat_video_responses_total': ('counter', 'Video responses, by status code'),
+    'aschat_video_range_requests_total': ('counter', 'Video requests carrying a Range header'),
+    'aschat_video_bytes_served_total': ('counter', 'Video body bytes sent in 200 and 206 responses'),
+    'aschat_upload_bytes_total': ('counter', 'Video upload bytes received, by mode'),
+    'aschat_upload_duration_seconds': ('histogram', 'Video upload request duration, by mode'),
+    'aschat_upload_throughput_bytes_per_second': ('histogram', 'Video upload request throughput, by mode'),
+    'aschat_log_records_dropped_total': ('counter', 'Log records dropped because the log queue was full'),
+    'aschat_http_requests_total': ('counter', 'HTTP requests handled, by endpoint'),
+    'aschat_http_request_duration_seconds': ('histogram', 'HTTP view latency (until the response is built), by endpoint'),
+}
+# Socket.IO events and HTTP views slower than this are logged as 'slow_event' with their payload size
+SLOW_EVENT_THRESHOLD = float(os.environ.get('SLOW_EVENT_MS', '100')) / 1000.0
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+metric_counters = {} # (name, labels) -> value; labels is a tuple of (key, value) pairs
+metric_histograms = {} # (name, labels) -> Histogram
+
+def count_metric(name, labels=(), amount=1):
+    key = (name, labels)
+    metric_counters[key] = metric_counters.get(key, 0) + amount
+
+def observe_metric(name, value, labels=(), buckets=LATENCY_BUCKETS):
+    histogram = metric_histograms.get((name, labels))
+    if histogram is None:
+        histogram = metric_histograms[(name, labels)] = Histogram(buckets)
+    histogram.observe(value)
+
+def payload_size(args):
+    # Only measured for slow events, so the JSON encoding never lands on the fast path
+    try:
+        return len(json.dumps(args, separators=(',', ':'), default=str))
+    except (TypeError, ValueError):
+        return None
+
+def metered(event):
+    # Wraps a Socket.IO handler (below @socketio.on) with a call counter, a latency histogram
+    # and the slow-event log
+    labels = (('event', event),)
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return handler(*args, **kwargs)
+            except Exception:
+                count_metric('aschat_socketio_event_errors_total', labels)
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                count_metric('aschat_socketio_events_total', labels)
+                observe_metric('aschat_socketio_event_duration_seconds', elapsed, labels)
+                if elapsed >= SLOW_EVENT_THRESHOLD:
+                    log_event('slow_event', kind='socketio', name=event, sid=request.sid,
+                              duration_ms=round(elapsed * 1000, 1), payload_bytes=payload_size(args))
+        return wrapper
+    return decorator
+
+def profiled_route(endpoint):
+    # The same for a Flask view. Streamed bodies (videos) are timed until the response is built.
+    labels = (('endpoint', endpoint),)
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                count_metric('aschat_http_requests_total', labels)
+                observe_metric('aschat_http_request_duration_seconds', elapsed, labels)
+                if elapsed >= SLOW_EVENT_THRESHOLD:
+                    log_event('slow_event', kind='http', name=endpoint, path=request.path,
+                              duration_ms=round(elapsed * 1000, 1), payload_bytes=request.content_length)
+        return wrapper
+    return decorator
+
+def broadcast(event, *args, room, include_self=True):
+    # socketio.emit to a room, recording how many clients on this worker it reaches
+    recipients = len(socketio.server.manager.rooms.get('/', {}).get(room, ()))
+    labels = (('event', event),)
+    count_metric('aschat_broadcasts_total', labels)
+    observe_metric('aschat_broadcast_recipients', recipients, labels, RECIPIENT_BUCKETS)
+    socketio.emit(event, *args, room=room, include_self=include_self)
+
+def record_upload(mode, size, started):
+    duration = max(time.perf_counter() - started, 1e-6)
+    labels = (('mode', mode),)
+    count_metric('aschat_upload_bytes_total', labels, size)
+    observe_metric('aschat_upload_duration_seconds', duration, labels, UPLOAD_DURATION_BUCKETS)
+    observe_metric('aschat_upload_throughput_bytes_per_second', size / duration, labels, THROUGHPUT_BUCKETS)
+
+def format_labels(labels, extra=()):
+    pairs = tuple(labels) + tuple(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+def render_metrics(gauges):
+    # gauges: [(name, help, value)]
+    lines = []
+    by_name = {}
+    for (name, labels), value in metric_counters.items():
+        by_name.setdefault(name, []).append(f'{name}{format_labels(labels)} {value}')
+    for (name, labels), histogram in metric_histograms.items():
+        samples = by_name.setdefault(name, [])
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+            cumulative += count
+            samples.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+        samples.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+        samples.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+    for name in sorted(by_name):
+        metric_type, help_text = METRIC_HELP.get(name, ('untyped', name))
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}'] + by_name[name]
+    for name, help_text, value in gauges:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {value}']
+    return '\n'.join(lines) + '\n'
+
+# --- Shared State Backend ---
+# Room state lives behind a small Redis-shaped interface (values, sets, hashes, counters).
+# Everything is stored JSON-encoded in both implementations, so code that forgets to write a
+# change back fails the same way in memory as it would against Redis.
+class InMemoryStateBackend:
+    def __init__(self):
+        self.values = {}
+        self.sets = {}
+        self.hashes = {}
+        self.lists = {}
+
+    def get(self, key, default=None):
+        raw = self.values.get(key)
+        return default if raw is None else json.loads(raw)
+
+    def set(self, key, value):
+        self.values[key] = json.dumps(value)
+
+    def incr(self, key):
+        value = int(self.values.get(key, 0)) + 1
+        self.values[key] = str(value)
+        return value
+
+    def sadd(self, key, member):
+        self.sets.setdefault(key, set()).add(member)
+
+    def srem(self, key, member):
+        self.sets.get(key, set()).discard(member)
+
+    def sismember(self, key, member):
+        return member in self.sets.get(key, ())
+
+    def smembers(self, key):
+        return set(self.sets.get(key, ()))
+
+    def scard(self, key):
+        return len(self.sets.get(key, ()))
+
+    def hget(self, key, field):
+        raw = self.hashes.get(key, {}).get(field)
+        return None if raw is None else json.loads(raw)
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[field] = json.dumps(value)
+
+    def hdel(self, key, field):
+        return self.hashes.get(key, {}).pop(field, None) is not None
+
+    def hexists(self, key, field):
+        return field in self.hashes.get(key, {})
+
+    def hgetall(self, key):
+        return {field: json.loads(raw) for field, raw in self.hashes.get(key, {}).items()}
+
+    def hlen(self, key):
+        return len(self.hashes.get(key, {}))
+
+    def rpush_capped(self, key, value, capacity):
+        # Appends to a list that keeps only its newest `capacity` items
+        items = self.lists.get(key)
+        if items is None or items.maxlen != capacity:
+            items = self.lists[key] = deque(items or (), maxlen=capacity)
+        items.append(json.dumps(value, separators=(',', ':')))
+
+    def lrange(self, key):
+        return [json.loads(raw) for raw in self.lists.get(key, ())]
+
+    def delete(self, key):
+        for store in (self.values, self.sets, self.hashes, self.lists):
+            store.pop(key, None)
+
+class RedisStateBackend:
+    # Works with a redis-py client or anything with the same methods (e.g. fakeredis for tests)
+    def __init__(self, client, prefix='aschat:'):
+        self.client = client
+        self.prefix = prefix
+
+    def key(self, key):
+        return self.prefix + key
+
+    @staticmethod
+    def text(value):
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def get(self, key, default=None):
+        raw = self.client.get(self.key(key))
+        return default if raw is None else json.loads(raw)
+
+    def set(self, key, value):
+        self.client.set(self.key(key), json.dumps(value))
+
+    def incr(self, key):
+        return int(self.client.incr(self.key(key)))
+
+    def sadd(self, key, member):
+        self.client.sadd(self.key(key), member)
+
+    def srem(self, key, member):
+        self.client.srem(self.key(key), member)
+
+    def sismember(self, key, member):
+        return bool(self.client.sismember(self.key(key), member))
 
-CHAT_ROOM = "main_as_chat_room"
+    def smembers(self, key):
+        return {self.text(member) for member in self.client.smembers(self.key(key))}
 
-hosts = set() # Stores session IDs of current hosts
-muted_users = set() # Stores session IDs of individual muted users
-chat_disabled_for_all = False # New flag to disable chat for everyone (except host)
+    def scard(self, key):
+        return int(self.client.scard(self.key(key)))
 
-# Stores user information (sid: {username, is_host, is_muted})
-user_info = {}
+    def hget(self, key, field):
+        raw = self.client.hget(self.key(key), field)
+        return None if raw is None else json.loads(raw)
+
+    def hset(self, key, field, value):
+        self.client.hset(self.key(key), field, json.dumps(value))
+
+    def hdel(self, key, field):
+        return bool(self.client.hdel(self.key(key), field))
+
+    def hexists(self, key, field):
+        return bool(self.client.hexists(self.key(key), field))
+
+    def hgetall(self, key):
+        return {self.text(field): json.loads(raw) for field, raw in self.client.hgetall(self.key(key)).items()}
+
+    def hlen(self, key):
+        return int(self.client.hlen(self.key(key)))
+
+    def rpush_capped(self, key, value, capacity):
+        pipe = self.client.pipeline()
+        pipe.rpush(self.key(key), json.dumps(value, separators=(',', ':')))
+        pipe.ltrim(self.key(key), -capacity, -1)
+        pipe.execute()
+
+    def lrange(self, key):
+        return [json.loads(raw) for raw in self.client.lrange(self.key(key), 0, -1)]
+
+    def delete(self, key):
+        self.client.delete(self.key(key))
+
+def create_state_backend():
+    if not REDIS_URL:
+        return InMemoryStateBackend()
+    if redis is None:
+        raise RuntimeError('REDIS_URL is set but the redis package is not installed')
+    return RedisStateBackend(redis.Redis.from_url(REDIS_URL))
+
+state = create_state_backend()
+
+# Set- and dict-like views over the backend, so handlers keep reading naturally
+# ('sid in hosts', 'user_info.get(sid)'). Values read from a SharedDict are copies:
+# changes must be written back with user_info[sid] = ...
+class SharedSet:
+    def __init__(self, backend, key):
+        self.backend = backend
+        self.key = key
+
+    def __contains__(self, member):
+        return member is not None and self.backend.sismember(self.key, member)
+
+    def __iter__(self):
+        return iter(self.backend.smembers(self.key))
+
+    def __len__(self):
+        return self.backend.scard(self.key)
+
+    def add(self, member):
+        self.backend.sadd(self.key, member)
+
+    def remove(self, member):
+        self.backend.srem(self.key, member)
+
+class SharedDict:
+    def __init__(self, backend, key):
+        self.backend = backend
+        self.key = key
+
+    def __contains__(self, field):
+        return field is not None and self.backend.hexists(self.key, field)
+
+    def __getitem__(self, field):
+        value = self.backend.hget(self.key, field)
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def __setitem__(self, field, value):
+        self.backend.hset(self.key, field, value)
+
+    def __len__(self):
+        return self.backend.hlen(self.key)
+
+    def get(self, field, default=None):
+        value = self.backend.hget(self.key, field)
+        return default if value is None else value
+
+    def pop(self, field, default=None):
+        value = self.get(field, default)
+        self.backend.hdel(self.key, field)
+        return value
+
+    def snapshot(self):
+        return self.backend.hgetall(self.key)
+
+# --- Rooms ---
+# Each room (picked with ?room=<name> on the page URL) has its own hosts, mutes, chat flag,
+# current video and playback state, stored under 'room:<name>:' in the state backend.
+# Rooms are created on first join and freed once they have been empty for ROOM_TTL seconds.
+DEFAULT_ROOM = 'main'
+ROOM_NAME_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+ROOM_TTL = float(os.environ.get('ROOM_TTL_SECONDS', '600'))
+ROOM_GC_INTERVAL = 60.0 # Seconds between sweeps for idle rooms
+
+class Room:
+    # Views over one room's state; cheap to create, so any worker can build one on demand
+    def __init__(self, room_id):
+        self.id = room_id
+        self.prefix = f'room:{room_id}:'
+        # Socket.IO rooms: broadcasts only reach this room's members
+        self.chat_room = f'chat:{room_id}'
+        self.hosts_room = f'hosts:{room_id}' # Hosts also join this room to receive user list updates
+        self.hosts = SharedSet(state, self.prefix + 'hosts') # Stores session IDs of current hosts
+        self.muted_users = SharedSet(state, self.prefix + 'muted_users') # Stores session IDs of individual muted users
+        # Stores user information (sid: {username, is_host, is_muted})
+        self.user_info = SharedDict(state, self.prefix + 'user_info')
+
+    # Scalar room state:
+    #   'chat_disabled_for_all': flag to disable chat for everyone (except host)
+    #   'user_list_revision': bumped on every user_info change; hosts receive deltas tagged with it
+    #   'current_video': the currently shared video ({'sha256', 'path', 'url', 'metadata'}) or None
+    #   'playback_state': server-side copy of the shared video's playback state, kept up to date
+    #       from host controls. 'position' is the media time at server wall-clock time 'anchor'.
+    #   'message_seq': id of the room's latest chat message
+    #   'chat_history': capped list of recent messages (see Chat History)
+    ROOM_STATE_KEYS = ('chat_disabled_for_all', 'user_list_revision', 'current_video', 'playback_state',
+                       'message_seq', 'chat_history')
+
+    def get(self, name, default=None):
+        return state.get(self.prefix + name, default)
+
+    def set(self, name, value):
+        state.set(self.prefix + name, value)
+
+    def incr(self, name):
+        return state.incr(self.prefix + name)
+
+    def delete(self):
+        for name in ('hosts', 'muted_users', 'user_info') + self.ROOM_STATE_KEYS:
+            state.delete(self.prefix + name)
+
+room_views = {} # room_id -> Room, per process
+# state hash 'rooms': room_id -> {'created', 'empty_since'}, the registry shared by all workers
+# state hash 'sid_rooms': sid -> room_id
+room_gc_started = False
+
+def normalize_room_id(room_id):
+    return room_id if room_id and ROOM_NAME_PATTERN.fullmatch(room_id) else DEFAULT_ROOM
+
+def get_room(room_id):
+    room = room_views.get(room_id)
+    if room is None:
+        room = room_views[room_id] = Room(room_id)
+    return room
+
+def room_of(sid):
+    room_id = state.hget('sid_rooms', sid) if sid else None
+    return get_room(room_id) if room_id else None
+
+def host_room(sid):
+    # The room sid is a host of, or None. HTTP endpoints identify hosts by their Socket.IO sid.
+    room = room_of(sid)
+    return room if room is not None and sid in room.hosts else None
+
+def enter_room(sid, room_id):
+    # Registers the room on first join and cancels any pending collection
+    global room_gc_started
+    room = get_room(room_id)
+    entry = state.hget('rooms', room_id)
+    if entry is None or entry['empty_since'] is not None:
+        state.hset('rooms', room_id, {'created': entry['created'] if entry else time.time(), 'empty_since': None})
+    state.hset('sid_rooms', sid, room_id)
+    if not room_gc_started:
+        room_gc_started = True
+        socketio.start_background_task(collect_idle_rooms_forever)
+    return room
+
+def leave_room_state(sid, room):
+    state.hdel('sid_rooms', sid)
+    if not len(room.user_info):
+        entry = state.hget('rooms', room.id) or {'created': time.time()}
+        state.hset('rooms', room.id, dict(entry, empty_since=time.time()))
+
+def free_room(room):
+    if room.get('current_video'):
+        set_shared_video(room, None) # Releases the store reference so the video can be evicted
+    room.delete()
+    delete_chat_log(room.id) # Message ids start over, so the old log cannot be continued
+    chat_batches.pop(room.id, None)
+    state.hdel('rooms', room.id)
+    room_views.pop(room.id, None)
+    log_event('room_freed', room=room.id)
+
+def collect_idle_rooms():
+    now = time.time()
+    for room_id, entry in state.hgetall('rooms').items():
+        room = get_room(room_id)
+        if len(room.user_info):
+            continue
+        if entry['empty_since'] is None: # Emptied without a clean leave, e.g. by a worker that died
+            state.hset('rooms', room_id, dict(entry, empty_since=now))
+        elif now - entry['empty_since'] >= ROOM_TTL:
+            free_room(room)
+
+def collect_idle_rooms_forever():
+    while True:
+        socketio.sleep(ROOM_GC_INTERVAL)
+        collect_idle_rooms()
 
 # --- Video Sharing Setup ---
 # Use an absolute path for UPLOAD_FOLDER for better compatibility across different hosting environments.
 # Ensure your hosting platform allows writing to this directory and it persists across restarts if needed.
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
+# Uploads and chat logs go under DATA_DIR, which defaults to the app directory
+DATA_DIR = os.path.abspath(os.environ.get('DATA_DIR', BASE_DIR))
+UPLOAD_FOLDER = os.path.join(DATA_DIR, 'uploads')
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
-# To store the path of the currently shared video on the server
-current_shared_video_server_path = None
+# In-progress resumable uploads live outside UPLOAD_FOLDER so clearing the shared video
+# never destroys an upload that is still running. Abandoned ones are removed once stale.
+PARTIAL_UPLOAD_FOLDER = os.path.join(DATA_DIR, 'uploads_partial')
+
+os.makedirs(PARTIAL_UPLOAD_FOLDER, exist_ok=True)
 
 # --- Frontend HTML, CSS, JavaScript as Python strings ---
 # It's generally better practice to serve these from static files (e.g., a 'static' folder)
 # in production, letting the web server (Nginx, Apache) handle them efficiently.
 # However, for a single-file Flask app, keeping them as strings is acceptable for small scale.
+# CSS and JS are published under content-hashed /assets/ URLs (see "Static Assets" below).
 
 CSS_CONTENT = """
 /* General Styling */
@@ -536,7 +1124,8 @@ h4 { font-size: 1em; color: var(--text-color-light); } /* Adjusted h4 size */
 """
 
 JS_CONTENT = """
-const socket = io();
+// The room comes from the page URL (?room=<name>); the server falls back to its default room
+const socket = io({ query: { room: new URLSearchParams(window.location.search).get('room') || '' } });
 
 const messagesDiv = document.getElementById('messages');
 const usernameInput = document.getElementById('usernameInput');
@@ -554,12 +1143,22 @@ const hostChatControlsDiv = document.getElementById('hostChatControls');
 const muteUserIdInput = document.getElementById('muteUserId');
 const toggleMuteBtn = document.getElementById('toggleMute');
 const toggleChatEnabledBtn = document.getElementById('toggleChatEnabled');
+const startProfileBtn = document.getElementById('startProfile');
 const connectedUsersList = document.getElementById('connectedUsersList');
 const videoContainer = document.getElementById('videoContainer');
 const noVideoMessage = document.getElementById('noVideoMessage');
 
 let isHost = false;
-let isChatEnabled = true;
+let isMuted = false;
+let isChatEnabled = true; // Room-wide flag; the server pushes changes with 'update_chat_status'
+
+let userListRev = -1; // Revision of the host user list we have applied; -1 means no snapshot yet
+let lastMessageId = null; // Id of the newest chat message shown; sent as 'since' when reconnecting
+// Workers publish on their own schedules, so ids can arrive out of order; remember which
+// ones were shown rather than dropping everything below the newest
+const SHOWN_MESSAGE_IDS_KEPT = 1000;
+const shownMessageIds = new Set();
+const userListItems = new Map(); // sid -> <li> element in connectedUsersList
 
 // --- Helper Functions ---
 function addMessage(data, type = 'user') {
@@ -580,6 +1179,7 @@ function addMessage(data, type = 'user') {
     }
     messagesDiv.appendChild(messageElement);
     messagesDiv.scrollTop = messagesDiv.scrollHeight;
+    return messageElement;
 }
 
 function showFeedback(message, type) {
@@ -595,19 +1195,58 @@ function showFeedback(message, type) {
     }, 2000);
 }
 
+function renderUserListItem(sid, userInfo) {
+    let listItem = userListItems.get(sid);
+    if (!listItem) {
+        listItem = document.createElement('li');
+        userListItems.set(sid, listItem);
+        connectedUsersList.appendChild(listItem);
+    }
+    let status = '';
+    if (userInfo.is_host) status += ' (Host)';
+    if (userInfo.is_muted) status += ' (Muted)';
+    listItem.textContent = `${sid}: ${userInfo.username}${status}`;
+}
+
 function updateConnectedUsersList(users) {
     connectedUsersList.innerHTML = '';
+    userListItems.clear();
     for (const sid in users) {
-        const userInfo = users[sid];
-        const listItem = document.createElement('li');
-        let status = '';
-        if (userInfo.is_host) status += ' (Host)';
-        if (userInfo.is_muted) status += ' (Muted)';
-        listItem.textContent = `${sid}: ${userInfo.username}${status}`;
-        connectedUsersList.appendChild(listItem);
+        renderUserListItem(sid, users[sid]);
     }
 }
 
+function applyUserListChanges(changes) {
+    for (const change of changes) {
+        if (change.op === 'remove') {
+            const listItem = userListItems.get(change.sid);
+            if (listItem) listItem.remove();
+            userListItems.delete(change.sid);
+        } else {
+            renderUserListItem(change.sid, change.user);
+        }
+    }
+}
+
+function applyPermissions() {
+    // Everything here derives from isHost, isMuted and isChatEnabled, which the server pushes
+    hostVideoControlsDiv.style.display = isHost ? 'flex' : 'none';
+    hostChatControlsDiv.style.display = isHost ? 'block' : 'none';
+    if (isHost) {
+        toggleChatEnabledBtn.textContent = isChatEnabled ? 'Disable Chat for All' : 'Enable Chat for All';
+        toggleChatEnabledBtn.className = isChatEnabled ? 'btn btn-warning' : 'btn btn-primary';
+    }
+    // Hosts can always chat; muted users cannot; everyone else follows the room-wide flag
+    toggleChatInput(isHost || (!isMuted && isChatEnabled));
+}
+
+function applyPermissionState(permissions) {
+    isHost = permissions.is_host;
+    isMuted = permissions.is_muted;
+    isChatEnabled = permissions.chat_enabled;
+    applyPermissions();
+}
+
 function toggleChatInput(enabled) {
     messageInput.disabled = !enabled;
     sendMessageBtn.disabled = !enabled;
@@ -652,6 +1291,25 @@ toggleChatEnabledBtn.addEventListener('click', () => {
     socket.emit('toggle_chat_enabled', { enabled: !isChatEnabled });
 });
 
+startProfileBtn.addEventListener('click', () => {
+    socket.emit('start_profile', { seconds: 10 }, (result) => {
+        if (!result || result.error === 'rate_limited') return; // The server already said so
+        addMessage({ msg: result.success ? 'Profiling the server for ' + result.seconds + 's...' : result.error },
+                   result.success ? 'system' : 'error');
+    });
+});
+
+socket.on('profile_ready', (data) => {
+    const element = addMessage({ msg: 'Server profile ready: ' }, 'system');
+    [['collapsed stacks', data.collapsed_url], ['pstats', data.pstats_url]].forEach(([label, url], i) => {
+        const link = document.createElement('a');
+        link.href = url;
+        link.textContent = label;
+        if (i) element.appendChild(document.createTextNode(' / '));
+        element.appendChild(link);
+    });
+});
+
 // --- Video Sharing Logic ---
 let currentVideoBlobUrl = null;
 
@@ -668,40 +1326,112 @@ videoFileInput.addEventListener('change', (event) => {
     }
 });
 
+// Resumable upload: chunks go up in parallel, failed chunks are retried, and after a
+// failure the server's status tells us which byte ranges still need sending.
+const UPLOAD_PARALLELISM = 3;
+const UPLOAD_MAX_RETRIES = 5;
+const UPLOAD_SINGLE_REQUEST_LIMIT = 8 * 1024 * 1024;
+const FINGERPRINT_SAMPLE_BYTES = 1024 * 1024;
+let uploadProgressMessage = null;
+
+function uploadApi(method, path, body) {
+    const separator = path.includes('?') ? '&' : '?';
+    // Include SID in the URL for basic authentication check on upload endpoints
+    return fetch(`${path}${separator}sid=${socket.id}`, { method, body }).then(response => {
+        return response.json().then(data => {
+            if (!response.ok) throw new Error(data.error || 'Server error');
+            return data;
+        });
+    });
+}
+
+function missingChunks(size, chunkSize, ranges) {
+    // Split every gap between received ranges into chunk-sized pieces
+    const chunks = [];
+    let position = 0;
+    for (const [start, end] of ranges.concat([[size, size]])) {
+        for (let offset = position; offset < start; offset += chunkSize) {
+            chunks.push([offset, Math.min(offset + chunkSize, start)]);
+        }
+        position = Math.max(position, end);
+    }
+    return chunks;
+}
+
+async function sendChunks(uploadId, file, chunks) {
+    const queue = chunks.slice();
+    const worker = async () => {
+        while (queue.length > 0) {
+            const [start, end] = queue.shift();
+            await uploadApi('PUT', `/uploads/${uploadId}?offset=${start}`, file.slice(start, end));
+        }
+    };
+    const workers = [];
+    for (let i = 0; i < UPLOAD_PARALLELISM; i++) workers.push(worker());
+    await Promise.all(workers);
+}
+
+async function videoFingerprint(file) {
+    // Must match file_fingerprint() on the server: SHA-256 of size, first MiB and last MiB
+    if (!window.crypto || !crypto.subtle) return null; // Only available in secure contexts
+    const parts = [String(file.size), file.slice(0, FINGERPRINT_SAMPLE_BYTES)];
+    if (file.size > FINGERPRINT_SAMPLE_BYTES) {
+        parts.push(file.slice(Math.max(FINGERPRINT_SAMPLE_BYTES, file.size - FINGERPRINT_SAMPLE_BYTES)));
+    }
+    const digest = await crypto.subtle.digest('SHA-256', await new Blob(parts).arrayBuffer());
+    return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+}
+
+async function uploadVideo(file) {
+    // Nothing to upload if the server already stores this video
+    const fingerprint = await videoFingerprint(file);
+    if (fingerprint) {
+        const lookup = await uploadApi('POST', '/video_lookup',
+            new Blob([JSON.stringify({ size: file.size, fingerprint })], { type: 'application/json' }));
+        if (lookup.found) return lookup;
+    }
+    // Small files go up in one streamed request; bigger ones use the resumable protocol
+    if (file.size <= UPLOAD_SINGLE_REQUEST_LIMIT) {
+        return uploadApi('POST', `/upload_video?filename=${encodeURIComponent(file.name)}`, file);
+    }
+    return uploadVideoResumable(file);
+}
+
+async function uploadVideoResumable(file) {
+    const created = await uploadApi('POST', '/uploads',
+        new Blob([JSON.stringify({ filename: file.name, size: file.size })], { type: 'application/json' }));
+    const uploadId = created.upload_id;
+    let status = { ranges: [], complete: false };
+
+    for (let attempt = 0; !status.complete; attempt++) {
+        try {
+            await sendChunks(uploadId, file, missingChunks(file.size, created.chunk_size, status.ranges));
+        } catch (error) {
+            if (attempt >= UPLOAD_MAX_RETRIES) throw error;
+            console.warn('Upload interrupted, resuming:', error);
+            await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** attempt));
+        }
+        status = await uploadApi('GET', `/uploads/${uploadId}`);
+    }
+    return uploadApi('POST', `/uploads/${uploadId}/finalize`);
+}
+
 startVideoShareBtn.addEventListener('click', () => {
     if (isHost && videoFileInput.files.length > 0) {
         const file = videoFileInput.files[0];
-        const formData = new FormData();
-        formData.append('video', file);
 
-        addMessage({ msg: 'Uploading video...', type: 'system' });
+        uploadProgressMessage = addMessage({ msg: 'Uploading video...', type: 'system' }, 'system');
 
-        // Include SID in the URL for basic authentication check on upload endpoint
-        // This is a basic check. For production, consider using proper session management
-        // and CSRF tokens if this endpoint were exposed without SocketIO's SID mechanism.
-        fetch(`/upload_video?sid=${socket.id}`, {
-            method: 'POST',
-            body: formData,
-        })
-        .then(response => {
-            if (!response.ok) { // Check for HTTP errors
-                return response.json().then(errorData => {
-                    throw new Error(errorData.error || 'Server error');
-                });
-            }
-            return response.json();
-        })
+        uploadVideo(file)
         .then(data => {
-            if (data.success) {
-                addMessage({ msg: 'Video uploaded successfully!', type: 'system' });
-                socket.emit('host_starts_video_share', { video_url: data.video_url });
-            } else {
-                addMessage({ msg: 'Video upload failed: ' + data.error, type: 'error' });
-            }
+            uploadProgressMessage = null;
+            addMessage({ msg: 'Video uploaded successfully!', type: 'system' }, 'system');
+            socket.emit('host_starts_video_share', { video_url: data.video_url });
         })
         .catch(error => {
+            uploadProgressMessage = null;
             console.error('Error uploading video:', error);
-            addMessage({ msg: 'Error uploading video: ' + error.message, type: 'error' });
+            addMessage({ msg: 'Error uploading video: ' + error.message, type: 'error' }, 'error');
         });
     } else if (!isHost) {
         alert('Only the host can share videos.');
@@ -720,20 +1450,35 @@ clearSharedVideoBtn.addEventListener('click', () => {
 
 // Host sending video control commands to synchronize playback
 let syncInterval;
+function sendHostVideoControl(action) {
+    // Every control says whether the host is playing, so a missed 'play' or 'pause' heals on the next sync
+    socket.emit('host_video_control', { action: action, time: sharedVideo.currentTime, rate: sharedVideo.playbackRate, playing: !sharedVideo.paused, sent_at: serverNow() });
+}
+
 sharedVideo.addEventListener('play', () => {
     if (isHost && !syncInterval) {
-        socket.emit('host_video_control', { action: 'play', time: sharedVideo.currentTime });
+        sendHostVideoControl('play');
         syncInterval = setInterval(() => {
             if (!sharedVideo.paused) {
-                socket.emit('host_video_control', { action: 'seek', time: sharedVideo.currentTime });
+                sendHostVideoControl('seek');
             }
         }, 3000); // Sync every 3 seconds
     }
 });
 
+sharedVideo.addEventListener('loadstart', () => {
+    // A new src (local preview -> uploaded URL) fires no 'pause', so start over here;
+    // the next 'play' is then reported instead of being swallowed by a stale interval
+    if (isHost && syncInterval) {
+        clearInterval(syncInterval);
+        syncInterval = null;
+    }
+    if (isHost && !sharedVideo.paused) sendHostVideoControl('play');
+});
+
 sharedVideo.addEventListener('pause', () => {
     if (isHost) {
-        socket.emit('host_video_control', { action: 'pause', time: sharedVideo.currentTime });
+        sendHostVideoControl('pause');
         if (syncInterval) {
             clearInterval(syncInterval);
             syncInterval = null;
@@ -743,7 +1488,7 @@ sharedVideo.addEventListener('pause', () => {
 
 sharedVideo.addEventListener('seeked', () => {
     if (isHost) {
-        socket.emit('host_video_control', { action: 'seek', time: sharedVideo.currentTime });
+        sendHostVideoControl('seek');
     }
 });
 
@@ -756,6 +1501,91 @@ sharedVideo.addEventListener('ended', () => {
     // socket.emit('host_clears_video'); 
 });
 
+// --- Clock Sync and Drift Correction ---
+// The client estimates its offset to the server clock NTP-style (keeping the lowest-RTT sample
+// of each burst). Sync events carry server timestamps, so each viewer can work out where the
+// host is *now* and correct small drift by nudging playbackRate instead of seeking.
+const CLOCK_SYNC_SAMPLES = 5;
+const CLOCK_SYNC_INTERVAL_MS = 60000;
+const DRIFT_TOLERANCE = 0.03; // Seconds of drift we simply accept
+const HARD_SEEK_THRESHOLD = 1.0; // Beyond this, seeking is cheaper than catching up
+const PAUSED_SEEK_THRESHOLD = 0.25;
+const MAX_RATE_ADJUST = 0.1; // Never play more than 10% faster/slower than the host
+const DRIFT_CORRECTION_SECONDS = 2.0; // Aim to close the gap over roughly this long
+
+let clockOffset = 0; // serverTime - clientTime, in seconds
+let playbackReference = null; // Latest host state: { playing, position, rate, server_time }
+
+function clientNow() {
+    return (performance.timeOrigin + performance.now()) / 1000;
+}
+
+function serverNow() {
+    return clientNow() + clockOffset;
+}
+
+function syncClock() {
+    let bestRtt = Infinity;
+    let remaining = CLOCK_SYNC_SAMPLES;
+    const sample = () => {
+        const t0 = clientNow();
+        socket.emit('clock_sync', {}, (data) => {
+            if (!data || data.server_time === undefined) return; // Rate limited; try again next round
+            const t1 = clientNow();
+            const rtt = t1 - t0;
+            if (rtt < bestRtt) {
+                bestRtt = rtt;
+                clockOffset = data.server_time - (t0 + t1) / 2;
+            }
+            if (--remaining > 0) sample();
+        });
+    };
+    sample();
+}
+setInterval(() => { if (socket.connected) syncClock(); }, CLOCK_SYNC_INTERVAL_MS);
+
+function expectedPosition(reference) {
+    if (!reference.playing) return reference.position;
+    return reference.position + (serverNow() - reference.server_time) * reference.rate;
+}
+
+function correctDrift() {
+    if (isHost || !playbackReference || !sharedVideo.src || sharedVideo.readyState < 1) return;
+    const target = expectedPosition(playbackReference);
+    const drift = sharedVideo.currentTime - target;
+
+    if (!playbackReference.playing) {
+        if (Math.abs(drift) > PAUSED_SEEK_THRESHOLD) sharedVideo.currentTime = target;
+        return;
+    }
+    if (Math.abs(drift) > HARD_SEEK_THRESHOLD) {
+        sharedVideo.currentTime = target;
+        sharedVideo.playbackRate = playbackReference.rate;
+    } else if (Math.abs(drift) > DRIFT_TOLERANCE) {
+        // Ahead -> slow down, behind -> speed up
+        const adjust = Math.max(-MAX_RATE_ADJUST, Math.min(MAX_RATE_ADJUST, drift / DRIFT_CORRECTION_SECONDS));
+        sharedVideo.playbackRate = playbackReference.rate * (1 - adjust);
+    } else if (sharedVideo.playbackRate !== playbackReference.rate) {
+        sharedVideo.playbackRate = playbackReference.rate;
+    }
+}
+setInterval(correctDrift, 500);
+
+function applyPlaybackReference(reference) {
+    playbackReference = reference;
+    if (isHost || sharedVideo.readyState < 1) return; // Applied on 'loadedmetadata' instead
+    if (reference.playing && sharedVideo.paused) {
+        sharedVideo.play().catch(e => console.error("Video auto-play prevented:", e));
+    } else if (!reference.playing && !sharedVideo.paused) {
+        sharedVideo.pause();
+    }
+    correctDrift();
+}
+
+sharedVideo.addEventListener('loadedmetadata', () => {
+    if (playbackReference) applyPlaybackReference(playbackReference);
+});
+
 // --- Socket.IO Event Handlers ---
 socket.on('connect', () => {
     console.log('Connected to server!');
@@ -763,56 +1593,96 @@ socket.on('connect', () => {
     mySidElement.classList.add('my-sid-display');
     mySidElement.textContent = `Your Session ID: ${socket.id}`;
     messagesDiv.prepend(mySidElement); // Add to the top of messages for visibility
-    socket.emit('request_initial_state'); // Request initial state on connect
+    syncClock();
+    requestInitialState(); // Request initial state on connect
 });
 
-socket.on('new_message', (data) => {
+function requestInitialState() {
+    socket.emit('request_initial_state', lastMessageId === null ? {} : { since: lastMessageId });
+}
+
+function addChatMessage(data) {
+    if (shownMessageIds.has(data.id)) return; // Already shown
+    shownMessageIds.add(data.id);
+    if (shownMessageIds.size > SHOWN_MESSAGE_IDS_KEPT) {
+        shownMessageIds.delete(shownMessageIds.values().next().value); // Oldest first
+    }
     addMessage(data);
+    if (lastMessageId === null || data.id > lastMessageId) lastMessageId = data.id;
+}
+
+socket.on('new_message', (data) => {
+    addChatMessage(data);
+});
+
+socket.on('new_messages', (data) => {
+    data.messages.forEach(addChatMessage); // A batch sent while the room is busy
 });
 
 socket.on('status', (data) => {
     addMessage(data, 'system');
 });
 
+socket.on('upload_progress', (data) => {
+    if (uploadProgressMessage) {
+        const percent = Math.floor(100 * data.received / data.size);
+        uploadProgressMessage.textContent = `Uploading video... ${percent}%`;
+    }
+});
+
+socket.on('presence', (data) => {
+    addMessage(data, 'system');
+});
+
 socket.on('host_authenticated', (data) => {
     if (data.success) {
-        isHost = true;
-        hostVideoControlsDiv.style.display = 'flex';
-        hostChatControlsDiv.style.display = 'block';
+        applyPermissionState(data.permissions);
         showFeedback('You are now authenticated as a host!', 'success');
-        socket.emit('request_user_list');
-        socket.emit('request_initial_state'); // Re-request initial state to get current video/chat status as host
+        // The server follows up with a full user list snapshot
     } else {
         showFeedback('Host authentication failed: ' + data.error, 'error');
     }
 });
 
-socket.on('you_are_muted', () => {
-    toggleChatInput(false);
+// Personal overrides arrive with this user's full permission state
+socket.on('you_are_muted', (permissions) => {
+    applyPermissionState(permissions);
     addMessage({ msg: 'You have been muted by the host. You cannot send messages.', type: 'error' });
 });
 
-socket.on('you_are_unmuted', () => {
-    // Only re-enable chat input if chat is globally enabled
-    // The 'update_chat_status' event will handle the global chat status.
-    // This just ensures the personal mute status is reflected.
-    socket.emit('get_my_user_status', {}, (status_data) => {
-        if (isChatEnabled && !status_data.is_muted) {
-            toggleChatInput(true);
-        }
-    });
+socket.on('you_are_unmuted', (permissions) => {
+    applyPermissionState(permissions);
     addMessage({ msg: 'You have been unmuted by the host. You can now send messages.', type: 'system' });
 });
 
+socket.on('permissions', (permissions) => {
+    applyPermissionState(permissions);
+});
+
 
 socket.on('update_user_list', (data) => {
     if (isHost) { // Only update if current user is a host
         updateConnectedUsersList(data.users);
+        userListRev = data.rev;
+    }
+});
+
+socket.on('user_list_delta', (data) => {
+    if (!isHost || userListRev < 0) return; // Not a host, or still waiting for a snapshot
+    if (data.rev <= userListRev) return; // Already covered by the snapshot we have
+    if (data.base_rev !== userListRev) {
+        // We missed an update; start over from a fresh snapshot
+        userListRev = -1;
+        socket.emit('request_user_list');
+        return;
     }
+    applyUserListChanges(data.changes);
+    userListRev = data.rev;
 });
 
 socket.on('start_video_playback', (data) => {
     if (data.video_url) {
+        playbackReference = null; // The host's next control for the new video sets this
         sharedVideo.src = data.video_url;
         sharedVideo.style.display = 'block';
         noVideoMessage.style.display = 'none';
@@ -823,6 +1693,7 @@ socket.on('start_video_playback', (data) => {
 });
 
 socket.on('clear_video_playback', () => {
+    playbackReference = null;
     sharedVideo.pause();
     sharedVideo.src = '';
     sharedVideo.style.display = 'none';
@@ -832,88 +1703,54 @@ socket.on('clear_video_playback', () => {
 
 socket.on('sync_video_playback', (data) => {
     if (!isHost) { // Only non-hosts should sync
-        if (data.action === 'play') {
+        if (data.server_time !== undefined) {
+            applyPlaybackReference({ playing: data.playing, position: data.time, rate: data.rate, server_time: data.server_time });
+        } else if (data.action === 'play') {
             sharedVideo.play().catch(e => console.error("Video auto-play prevented:", e));
         } else if (data.action === 'pause') {
             sharedVideo.pause();
-        } else if (data.action === 'seek' && data.time !== undefined) {
-            // Only seek if difference is significant to avoid constant seeking
-            if (Math.abs(sharedVideo.currentTime - data.time) > 1.0) { // Increased threshold slightly
-                sharedVideo.currentTime = data.time;
-            }
         }
     }
 });
 
 socket.on('update_chat_status', (data) => {
+    // Sent once to the whole room; combined with this user's own state locally
     isChatEnabled = data.enabled;
-    if (isHost) {
-        toggleChatEnabledBtn.textContent = isChatEnabled ? 'Disable Chat for All' : 'Enable Chat for All';
-        toggleChatEnabledBtn.className = isChatEnabled ? 'btn btn-warning' : 'btn btn-primary';
-    }
-
-    // Determine chat input state based on global chat status and user's mute status
-    socket.emit('get_my_user_status', {}, (status_data) => {
-        if (status_data.is_host) {
-            toggleChatInput(true); // Host can always chat
-        } else if (status_data.is_muted) {
-            toggleChatInput(false); // Muted users cannot chat
-        } else {
-            toggleChatInput(isChatEnabled); // Non-muted users follow global chat status
-        }
+    applyPermissions();
 
-        if (!isHost) { // Only show status message for non-hosts
-            if (!isChatEnabled && !status_data.is_muted) { // If chat disabled globally and not personally muted
-                addMessage({ msg: 'Chat has been disabled by the host.', type: 'system' });
-            } else if (isChatEnabled && !status_data.is_muted) { // If chat enabled globally and not personally muted
-                addMessage({ msg: 'Chat has been re-enabled by the host.', type: 'system' });
-            }
-        }
-    });
+    if (!isHost && !isMuted) { // Only show status message for non-hosts who are not personally muted
+        addMessage({ msg: isChatEnabled ? 'Chat has been re-enabled by the host.' : 'Chat has been disabled by the host.', type: 'system' });
+    }
 });
 
 socket.on('initial_state', (data) => {
-    isChatEnabled = data.chat_enabled;
+    applyPermissionState(data.permissions);
     const mySid = socket.id;
 
-    // Request user status to update host controls and chat input correctly
-    socket.emit('get_my_user_status', {}, (status_data) => {
-        isHost = status_data.is_host; // Update isHost status on initial state
-        if (isHost) {
-             hostVideoControlsDiv.style.display = 'flex';
-             hostChatControlsDiv.style.display = 'block';
-             toggleChatEnabledBtn.textContent = isChatEnabled ? 'Disable Chat for All' : 'Enable Chat for All';
-             toggleChatEnabledBtn.className = isChatEnabled ? 'btn btn-warning' : 'btn btn-primary';
-        } else {
-            hostVideoControlsDiv.style.display = 'none';
-            hostChatControlsDiv.style.display = 'none';
-        }
-
-        // Apply chat input state based on host status, mute status, and global chat status
-        if (status_data.is_host) {
-            toggleChatInput(true); // Host can always chat
-        } else if (status_data.is_muted) {
-            toggleChatInput(false); // Muted users cannot chat
-        } else {
-            toggleChatInput(isChatEnabled); // Non-muted users follow global chat status
-        }
-    });
+    if (data.history_reset) { // The room was recreated; ids started over
+        lastMessageId = null;
+        shownMessageIds.clear();
+    }
+    if (!data.history_complete && data.history.length) {
+        addMessage({ msg: 'Earlier messages are no longer available.' }, 'system');
+    }
+    data.history.forEach(addChatMessage);
 
     if (data.current_video_url) {
+        // Re-requested by a new host for the same video; keep the player as it is
+        if (sharedVideo.getAttribute('src') === data.current_video_url) return;
         sharedVideo.src = data.current_video_url;
         sharedVideo.style.display = 'block';
         noVideoMessage.style.display = 'none';
+        // A late joiner starts where the host currently is, once the video can seek
+        playbackReference = data.playback;
         sharedVideo.load();
-        // Don't auto-play on initial load for all, only when initiated by host sync
+        // Only auto-play on initial load if the host is currently playing
     } else {
         sharedVideo.style.display = 'none';
         noVideoMessage.style.display = 'block';
     }
 });
-
-socket.on('get_my_user_status_response', (data) => {
-    // This callback is handled by the socket.emit call, no global listener needed
-});
 """
 
 HTML_TEMPLATE = """
@@ -923,7 +1760,7 @@ HTML_TEMPLATE = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>As Chat - Group Chat</title>
-    <style>{css_content}</style>
+    <link rel="stylesheet" href="{css_url}">
     <script src="https://cdnjs.cloudflare.com/ajax/libs/socket.io/4.0.0/socket.io.js"></script>
     <link href="https://fonts.googleapis.com/css2?family=Roboto:wght@300;400;700&display=swap" rel="stylesheet">
 </head>
@@ -954,8 +1791,8 @@ HTML_TEMPLATE = """
                 <div id="messages" class="message-box">
                     </div>
                 <div class="input-area">
-                    <input type="text" id="usernameInput" placeholder="Your Name" value="Anonymous" class="text-input">
-                    <input type="text" id="messageInput" placeholder="Type your message..." autocomplete="off" class="text-input">
+                    <input type="text" id="usernameInput" placeholder="Your Name" value="Anonymous" maxlength="50" class="text-input">
+                    <input type="text" id="messageInput" placeholder="Type your message..." autocomplete="off" maxlength="2000" class="text-input">
                     <button id="sendMessage" class="btn btn-primary">Send</button>
                 </div>
                 <div class="host-auth-area">
@@ -966,6 +1803,7 @@ HTML_TEMPLATE = """
                 <div id="hostChatControls" class="host-controls-section" style="display: none;">
                     <h3>Host Chat Controls</h3>
                     <button id="toggleChatEnabled" class="btn btn-warning">Disable Chat for All</button>
+                    <button id="startProfile" class="btn btn-info">Profile Server (10s)</button>
                     <div class="user-mute-controls">
                         <h4>Connected Users (SID: Username):</h4>
                         <ul id="connectedUsersList" class="user-list"></ul>
@@ -977,78 +1815,804 @@ HTML_TEMPLATE = """
         </main>
     </div>
 
-    <script>{js_content}</script>
+    <script src="{js_url}"></script>
 </body>
 </html>
 """
 
+# --- Pre-rendered Page Cache ---
+# The page is identical for every visitor, so it is rendered and compressed once at startup
+# instead of on every request. Each encoding gets its own strong ETag.
+
+def build_cached_body(body, content_type):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    variants = {'identity': (body, f'"{digest}"')}
+    variants['gzip'] = (gzip.compress(body, compresslevel=9, mtime=0), f'"{digest}-gz"')
+    if brotli is not None:
+        variants['br'] = (brotli.compress(body, quality=11), f'"{digest}-br"')
+    return {'content_type': content_type, 'digest': digest, 'variants': variants}
+
+def pick_encoding(cached):
+    # Prefer the smallest encoding the client accepts (br > gzip > identity)
+    accepted = request.accept_encodings
+    for encoding in ('br', 'gzip'):
+        if encoding in cached['variants'] and accepted.quality(encoding) > 0:
+            return encoding
+    return 'identity'
+
+def serve_cached_body(cached, cache_control):
+    encoding = pick_encoding(cached)
+    body, etag = cached['variants'][encoding]
+    headers = {'ETag': etag, 'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+
+    # Any of our variant tags means the client already holds the current content
+    if_none_match = request.if_none_match
+    if if_none_match and (if_none_match.star_tag or
+                          any(if_none_match.contains_weak(tag.strip('"'))
+                              for _, tag in cached['variants'].values())):
+        return Response(status=304, headers=headers)
+
+    return Response(body, 200, content_type=cached['content_type'], headers=headers)
+
+# --- Static Assets ---
+# CSS and JS are served as separate files whose names contain a hash of their content,
+# so browsers can cache them forever and only download them again when they change.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+STATIC_ASSETS = {}
+
+def register_static_asset(name, extension, content, content_type):
+    cached = build_cached_body(content, content_type)
+    filename = f"{name}.{cached['digest'][:16]}.{extension}"
+    STATIC_ASSETS[filename] = cached
+    return f"/assets/{filename}"
+
+CSS_URL = register_static_asset('app', 'css', CSS_CONTENT, 'text/css; charset=utf-8')
+JS_URL = register_static_asset('app', 'js', JS_CONTENT, 'application/javascript; charset=utf-8')
+
+INDEX_PAGE = build_cached_body(HTML_TEMPLATE.format(css_url=CSS_URL, js_url=JS_URL),
+                               'text/html; charset=utf-8')
+
 # --- Flask Routes ---
 
 @app.route('/')
 def index():
-    # Render the HTML template by injecting CSS and JS content
-    return HTML_TEMPLATE.format(css_content=CSS_CONTENT, js_content=JS_CONTENT)
+    # Serve the pre-rendered page; browsers revalidate with If-None-Match on each load
+    return serve_cached_body(INDEX_PAGE, 'no-cache')
+
+@app.route('/assets/<filename>')
+def serve_static_asset(filename):
+    cached = STATIC_ASSETS.get(filename)
+    if cached is None:
+        return "Asset not found", 404
+    return serve_cached_body(cached, IMMUTABLE_CACHE_CONTROL)
+
+# --- Host User List Updates ---
+# Hosts get a full snapshot once, then only the changes. Each change is emitted once to
+# HOSTS_ROOM so it is serialized a single time no matter how many hosts are connected.
+# A host that sees a gap in revisions asks for a new snapshot via 'request_user_list'.
+
+def user_list_change(room, op, sid):
+    if op == 'remove':
+        return {'op': 'remove', 'sid': sid}
+    return {'op': op, 'sid': sid, 'user': room.user_info[sid]}
+
+def publish_user_list_changes(room, changes):
+    if not changes:
+        return
+    revision = room.incr('user_list_revision') # Atomic, so workers never reuse a revision
+    broadcast('user_list_delta', {
+        'rev': revision,
+        'base_rev': revision - 1,
+        'changes': changes
+    }, room=room.hosts_room)
+
+def send_user_list_snapshot(room, sid):
+    revision = room.get('user_list_revision', 0)
+    emit('update_user_list', {'users': room.user_info.snapshot(), 'rev': revision}, room=sid)
+
+# --- Presence Aggregation ---
+# Joins and leaves are buffered for PRESENCE_WINDOW_MS and announced to the room as one
+# 'presence' event, and the matching host user list changes go out as one delta.
+# This turns a reconnect storm of N clients into one broadcast instead of N.
+PRESENCE_WINDOW = float(os.environ.get('PRESENCE_WINDOW_MS', '250')) / 1000.0
+PRESENCE_NAME_PREVIEW = 10 # Max names spelled out in the announcement text
+
+pending_joins = {} # sid -> room_id, in join order
+pending_leaves = [] # (room_id, sid, username) in leave order; username None = not announced
+presence_flush_scheduled = False
+
+def queue_presence(room, sid, joined, username=None):
+    global presence_flush_scheduled
+    if joined:
+        pending_joins[sid] = room.id
+    elif pending_joins.pop(sid, None):
+        # Joined and left within the same window: no announcement, but a host may have taken
+        # a user list snapshot in between, so the removal still goes out (it is idempotent)
+        pending_leaves.append((room.id, sid, None))
+    else:
+        pending_leaves.append((room.id, sid, username))
+
+    if PRESENCE_WINDOW <= 0:
+        flush_presence()
+    elif not presence_flush_scheduled:
+        presence_flush_scheduled = True
+        socketio.start_background_task(flush_presence_after_window)
+
+def flush_presence_after_window():
+    socketio.sleep(PRESENCE_WINDOW)
+    flush_presence()
+
+def describe_presence(joined, left):
+    if len(joined) == 1 and not left:
+        return f'{joined[0]} has joined.'
+    if len(left) == 1 and not joined:
+        return f'{left[0]} has disconnected.'
+    parts = []
+    if joined:
+        parts.append(f"{len(joined)} user{'s' if len(joined) != 1 else ''} joined")
+    if left:
+        parts.append(f'{len(left)} left')
+    names = (joined + left)[:PRESENCE_NAME_PREVIEW]
+    more = len(joined) + len(left) - len(names)
+    return f"{', '.join(parts)}: {', '.join(names)}" + (f' and {more} more.' if more else '.')
+
+def flush_presence():
+    global presence_flush_scheduled
+    presence_flush_scheduled = False
+    # One batch per room, so each room only hears about its own members
+    batches = {}
+    for sid, room_id in pending_joins.items():
+        batches.setdefault(room_id, ([], []))[0].append(sid)
+    for room_id, sid, username in pending_leaves:
+        batches.setdefault(room_id, ([], []))[1].append((sid, username))
+    pending_joins.clear()
+    pending_leaves.clear()
+    for room_id, (joined_sids, leaves) in batches.items():
+        flush_room_presence(get_room(room_id), joined_sids, leaves)
+
+def flush_room_presence(room, joined_sids, leaves):
+    joined_sids = [sid for sid in joined_sids if sid in room.user_info]
+    if not joined_sids and not leaves:
+        return
+
+    # Joiners are described from current user_info, so a rename during the window is not lost
+    changes = [user_list_change(room, 'add', sid) for sid in joined_sids]
+    changes += [user_list_change(room, 'remove', sid) for sid, _ in leaves]
+    publish_user_list_changes(room, changes)
+
+    joined = [room.user_info[sid]['username'] for sid in joined_sids]
+    left = [username for _, username in leaves if username is not None]
+    if not joined and not left:
+        return
+    broadcast('presence', {
+        'msg': describe_presence(joined, left),
+        'type': 'system',
+        'joined': joined,
+        'left': left
+    }, room=room.chat_room)
+
+# --- Chat History ---
+# Each room keeps its last CHAT_HISTORY_SIZE messages in a capped list, each stored as a
+# compact [id, time, username, message] array. Together with MAX_MESSAGE_LENGTH that bounds
+# a room's history at a fixed size. Joiners get it with 'initial_state'; reconnecting clients
+# pass the last id they saw as 'since' and only get what they missed.
+CHAT_HISTORY_SIZE = int(os.environ.get('CHAT_HISTORY_SIZE', '200'))
+MAX_MESSAGE_LENGTH = 2000 # Characters
+MAX_USERNAME_LENGTH = 50
+
+def record_chat_message(room, username, message):
+    message_id = room.incr('message_seq')
+    sent_at = round(time.time(), 3)
+    state.rpush_capped(room.prefix + 'chat_history', [message_id, sent_at, username, message], CHAT_HISTORY_SIZE)
+    get_chat_log(room.id).append(message_id, sent_at, username, message)
+    return {'id': message_id, 'time': sent_at, 'username': username, 'message': message}
+
+def chat_history(room, since=None):
+    # Returns (messages, complete, reset). complete is False when messages older than the
+    # buffer were missed; reset is True when 'since' is from before the room was recreated.
+    messages = [{'id': message_id, 'time': sent_at, 'username': username, 'message': message}
+                for message_id, sent_at, username, message in state.lrange(room.prefix + 'chat_history')]
+    if not isinstance(since, int) or since < 0:
+        return messages, not messages or messages[0]['id'] == 1, False
+    if since > room.get('message_seq', 0):
+        return messages, not messages or messages[0]['id'] == 1, True
+    missed = [message for message in messages if message['id'] > since]
+    return missed, not messages or messages[0]['id'] <= since + 1, False
+
+# --- Chat Fan-out ---
+# A message that arrives when the room has been quiet for CHAT_BATCH_WINDOW_MS goes out at
+# once as 'new_message'. Messages that follow within the window are gathered and sent as one
+# 'new_messages' frame when the window ends, or as soon as CHAT_BATCH_MAX are waiting. Quiet
+# rooms keep their latency; busy rooms cost one encode and one frame per batch.
+CHAT_BATCH_WINDOW = float(os.environ.get('CHAT_BATCH_WINDOW_MS', '20')) / 1000.0
+CHAT_BATCH_MAX = 50
+
+chat_batches = {} # room_id -> {'messages', 'last_sent', 'scheduled'}
+
+def broadcast_chat_message(room, message):
+    batch = chat_batches.setdefault(room.id, {'messages': [], 'last_sent': 0.0, 'scheduled': False})
+    now = time.monotonic()
+    if not batch['messages'] and now - batch['last_sent'] >= CHAT_BATCH_WINDOW:
+        batch['last_sent'] = now
+        broadcast('new_message', message, room=room.chat_room)
+        return
+
+    batch['messages'].append(message)
+    if len(batch['messages']) >= CHAT_BATCH_MAX:
+        flush_chat_batch(room)
+    elif not batch['scheduled']:
+        batch['scheduled'] = True
+        socketio.start_background_task(flush_chat_batch_after_window, room)
+
+def flush_chat_batch_after_window(room):
+    socketio.sleep(CHAT_BATCH_WINDOW)
+    batch = chat_batches.get(room.id)
+    if batch is not None:
+        batch['scheduled'] = False
+        flush_chat_batch(room)
+
+def flush_chat_batch(room):
+    batch = chat_batches.get(room.id)
+    if not batch or not batch['messages']:
+        return
+    messages = batch['messages']
+    batch['messages'] = []
+    batch['last_sent'] = time.monotonic()
+    broadcast('new_messages', {'messages': messages}, room=room.chat_room)
+
+# --- Chat Log ---
+# Every message is also appended to an on-disk log per room, CHAT_LOG_FOLDER/<room>/, made
+# of segments named after their first message id. A record is a 12-byte header (payload
+# length, message id) followed by a compact JSON [time, username, message] payload. Each
+# segment has a sparse index (<first id>.idx) of (id, offset) pairs, one every
+# CHAT_LOG_INDEX_INTERVAL records. Appends are buffered and written and fsynced in batches,
+# so a crash loses at most CHAT_LOG_FLUSH_MS of chat. GET /history pages backwards through
+# the log by mmapping a segment and scanning only the index windows it needs.
+# Several workers may append to the same room (ids come from the room's shared counter), so
+# each writing worker owns a partition, CHAT_LOG_FOLDER/<room>/w<n>/, claimed with an flock
+# on its lock file and held while the process lives. Within a partition ids only grow, which
+# keeps the index bisectable; reads merge every partition. A partition whose owner is gone
+# is adopted (and its torn tail repaired) by the next worker that writes to the room.
+CHAT_LOG_FOLDER = os.path.join(DATA_DIR, 'chat_logs')
+CHAT_LOG_SEGMENT_BYTES = int(os.environ.get('CHAT_LOG_SEGMENT_BYTES', 16 * 1024 * 1024))
+CHAT_LOG_INDEX_INTERVAL = 64 # Records per sparse index entry
+CHAT_LOG_FLUSH_INTERVAL = float(os.environ.get('CHAT_LOG_FLUSH_MS', '1000')) / 1000.0
+CHAT_LOG_FLUSH_BYTES = 256 * 1024 # Buffered bytes that force an early flush
+CHAT_LOG_RECORD_HEADER = struct.Struct('>IQ') # payload length, message id
+CHAT_LOG_INDEX_ENTRY = struct.Struct('>QQ') # message id, record offset in the segment
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 200
+
+os.makedirs(CHAT_LOG_FOLDER, exist_ok=True)
+
+class ChatLogSegment:
+    def __init__(self, folder, first_id):
+        self.first_id = first_id
+        self.path = os.path.join(folder, f'{first_id:020d}.log')
+        self.index_path = os.path.join(folder, f'{first_id:020d}.idx')
+        self.index = [] # [(message_id, offset)], ascending
+        self.size = 0 # Bytes written to the segment file
+        self.last_id = None
+        self.since_index = 0 # Records appended after the last index entry
+
+    def load(self, repair=True):
+        # Reads the index and rescans the segment after its last index entry, which rebuilds
+        # entries lost in a crash and truncates a torn final record. Readers of a partition
+        # another worker owns (repair=False) stop before a record still being written.
+        self.size = os.path.getsize(self.path)
+        try:
+            with open(self.index_path, 'rb') as f:
+                raw = f.read()
+        except OSError:
+            raw = b''
+        for position in range(0, len(raw) - len(raw) % CHAT_LOG_INDEX_ENTRY.size, CHAT_LOG_INDEX_ENTRY.size):
+            message_id, offset = CHAT_LOG_INDEX_ENTRY.unpack_from(raw, position)
+            if offset >= self.size or (self.index and offset <= self.index[-1][1]):
+                break
+            self.index.append((message_id, offset))
+        indexed = len(self.index)
+
+        position = self.index[-1][1] if self.index else 0
+        self.since_index = 0 if self.index else CHAT_LOG_INDEX_INTERVAL
+        with open(self.path, 'rb') as f:
+            f.seek(position)
+            while True:
+                header = f.read(CHAT_LOG_RECORD_HEADER.size)
+                if len(header) < CHAT_LOG_RECORD_HEADER.size:
+                    break
+                length, message_id = CHAT_LOG_RECORD_HEADER.unpack(header)
+                if len(f.read(length)) < length:
+                    break
+                if position > (self.index[-1][1] if self.index else -1):
+                    self.note_record(message_id, position)
+                else:
+                    self.since_index = 1
+                self.last_id = message_id
+                position += CHAT_LOG_RECORD_HEADER.size + length
+        if position < self.size:
+            self.index = [entry for entry in self.index if entry[1] < position]
+            indexed = min(indexed, len(self.index))
+            self.size = position
+            if not repair:
+                return
+            log_event('chat_log_truncated', path=self.path, offset=position)
+            os.truncate(self.path, position)
+        if repair and len(self.index) > indexed:
+            with open(self.index_path, 'wb') as f:
+                f.write(b''.join(CHAT_LOG_INDEX_ENTRY.pack(*entry) for entry in self.index))
+
+    def note_record(self, message_id, offset):
+        # Returns the index entry for this record, if it gets one
+        if self.since_index < CHAT_LOG_INDEX_INTERVAL:
+            self.since_index += 1
+            return None
+        self.index.append((message_id, offset))
+        self.since_index = 1
+        return (message_id, offset)
+
+class ChatLogPartition:
+    # One worker's share of a room's log; only its owner appends to it
+    def __init__(self, folder, repair):
+        self.folder = folder
+        self.segments = []
+        self.pending = bytearray() # Encoded records not yet written to the last segment
+        self.pending_index = [] # Index entries for those records
+        self.unsynced = [] # Segments written since the last sync(); a rollover leaves two
+        self.refresh(repair)
+
+    def refresh(self, repair=False):
+        # Picks up segments the owner created or appended to since we last looked
+        known = {segment.first_id: segment for segment in self.segments}
+        segments = []
+        for item in sorted(os.listdir(self.folder)):
+            if item.endswith('.log') and item[:-4].isdigit():
+                segment = known.get(int(item[:-4]))
+                if segment is None or os.path.getsize(segment.path) != segment.size:
+                    segment = ChatLogSegment(self.folder, int(item[:-4]))
+                    segment.load(repair)
+                segments.append(segment)
+        self.segments = segments
+
+    @property
+    def last_id(self):
+        for segment in reversed(self.segments):
+            if segment.last_id is not None:
+                return segment.last_id
+        return 0
+
+    def append(self, message_id, sent_at, username, message):
+        payload = json.dumps([sent_at, username, message], separators=(',', ':')).encode('utf-8')
+        record = CHAT_LOG_RECORD_HEADER.pack(len(payload), message_id) + payload
+        segment = self.segments[-1] if self.segments else None
+        if segment is None or segment.size + len(self.pending) >= CHAT_LOG_SEGMENT_BYTES:
+            self.flush()
+            segment = ChatLogSegment(self.folder, message_id)
+            segment.since_index = CHAT_LOG_INDEX_INTERVAL # The first record is always indexed
+            self.segments.append(segment)
+        entry = segment.note_record(message_id, segment.size + len(self.pending))
+        if entry:
+            self.pending_index.append(entry)
+        segment.last_id = message_id
+        self.pending += record
+        if len(self.pending) >= CHAT_LOG_FLUSH_BYTES:
+            self.sync()
+
+    def flush(self):
+        # Hands buffered records to the OS; durability comes with the next sync()
+        if not self.pending:
+            return
+        segment = self.segments[-1]
+        with open(segment.path, 'ab') as f:
+            f.write(self.pending)
+        if self.pending_index:
+            with open(segment.index_path, 'ab') as f:
+                f.write(b''.join(CHAT_LOG_INDEX_ENTRY.pack(*entry) for entry in self.pending_index))
+        segment.size += len(self.pending)
+        self.pending = bytearray()
+        self.pending_index = []
+        if segment not in self.unsynced:
+            self.unsynced.append(segment)
+
+    def sync(self):
+        self.flush()
+        for segment in self.unsynced:
+            fsync_path(segment.path)
+            if os.path.exists(segment.index_path):
+                fsync_path(segment.index_path)
+        self.unsynced = []
+
+    def read_page(self, before, limit):
+        # The newest `limit` messages with id < before, oldest first
+        messages = []
+        for segment in reversed(self.segments):
+            if len(messages) >= limit:
+                break
+            if segment.first_id < before and segment.size:
+                messages = read_segment_page(segment, before, limit - len(messages)) + messages
+        return messages
+
+class ChatLog:
+    # A room's log: the partition this worker writes to, plus read-only views of the others
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.writer = None # Claimed on the first append
+        self.lock = None # Open lock file of the writer's partition
+        self.readers = {} # partition folder -> ChatLogPartition
+
+    def partitions(self):
+        for item in sorted(os.listdir(self.folder)):
+            folder = os.path.join(self.folder, item)
+            if self.writer is not None and folder == self.writer.folder:
+                continue
+            if item[:1] == 'w' and item[1:].isdigit() and os.path.isdir(folder):
+                reader = self.readers.get(folder)
+                if reader is None:
+                    reader = self.readers[folder] = ChatLogPartition(folder, repair=False)
+                else:
+                    reader.refresh()
+                yield reader
+        if self.writer is not None:
+            self.writer.flush()
+            yield self.writer
+
+    def claim_partition(self):
+        # The first partition nobody holds is ours; the flock lasts as long as the process
+        number = 0
+        while True:
+            folder = os.path.join(self.folder, f'w{number}')
+            os.makedirs(folder, exist_ok=True)
+            lock = open(os.path.join(folder, 'lock'), 'a')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                number += 1
+                continue
+            self.lock = lock
+            self.readers.pop(folder, None)
+            return ChatLogPartition(folder, repair=True)
+
+    @property
+    def last_id(self):
+        return max((partition.last_id for partition in self.partitions()), default=0)
+
+    def append(self, message_id, sent_at, username, message):
+        if self.writer is None:
+            self.writer = self.claim_partition()
+        self.writer.append(message_id, sent_at, username, message)
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+
+    def sync(self):
+        if self.writer is not None:
+            self.writer.sync()
+
+    def read_page(self, before=None, limit=HISTORY_PAGE_SIZE):
+        # The newest `limit` messages with id < before, oldest first, across all partitions
+        before = before if before is not None else float('inf')
+        messages = []
+        for partition in self.partitions():
+            messages += partition.read_page(before, limit)
+        messages.sort(key=lambda message: message['id'])
+        return messages[-limit:]
+
+    def close(self):
+        self.sync()
+        if self.lock is not None:
+            self.lock.close() # Releases the flock
+            self.lock = None
+        self.writer = None
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def read_segment_page(segment, before, limit):
+    # Scans backwards one index window at a time, so an old page touches only a few windows
+    # of the mapped segment
+    with open(segment.path, 'rb') as f, mmap.mmap(f.fileno(), segment.size, access=mmap.ACCESS_READ) as view:
+        entry = bisect.bisect_left(segment.index, (before, -1)) # Entries before this start below `before`
+        window_end = segment.index[entry][1] if entry < len(segment.index) else segment.size
+        messages = []
+        while entry > 0 and len(messages) < limit:
+            entry -= 1
+            window_start = segment.index[entry][1]
+            messages = scan_chat_log(view, window_start, window_end, before) + messages
+            window_end = window_start
+        return messages[-limit:]
+
+def scan_chat_log(view, start, end, before):
+    messages = []
+    position = start
+    while position < end:
+        length, message_id = CHAT_LOG_RECORD_HEADER.unpack_from(view, position)
+        position += CHAT_LOG_RECORD_HEADER.size
+        if message_id < before:
+            sent_at, username, message = json.loads(view[position:position + length])
+            messages.append({'id': message_id, 'time': sent_at, 'username': username, 'message': message})
+        position += length
+    return messages
+
+chat_logs = {} # room_id -> ChatLog
+chat_log_sync_started = False
+
+def get_chat_log(room_id):
+    global chat_log_sync_started
+    log = chat_logs.get(room_id)
+    if log is None:
+        log = chat_logs[room_id] = ChatLog(os.path.join(CHAT_LOG_FOLDER, room_id))
+    if not chat_log_sync_started:
+        chat_log_sync_started = True
+        socketio.start_background_task(sync_chat_logs_forever)
+    return log
+
+def sync_chat_logs_forever():
+    while True:
+        socketio.sleep(CHAT_LOG_FLUSH_INTERVAL)
+        for log in list(chat_logs.values()):
+            log.sync()
+
+def delete_chat_log(room_id):
+    log = chat_logs.pop(room_id, None)
+    if log is not None:
+        log.close()
+    remove_path(os.path.join(CHAT_LOG_FOLDER, room_id))
+
+def recover_chat_logs():
+    # Logs outlive the process: keep their rooms' ids moving forward and register the rooms,
+    # so the idle sweep frees them if nobody comes back
+    for room_id in os.listdir(CHAT_LOG_FOLDER):
+        if not ROOM_NAME_PATTERN.fullmatch(room_id):
+            continue
+        room = get_room(room_id)
+        last_id = get_chat_log(room_id).last_id
+        if room.get('message_seq', 0) < last_id:
+            room.set('message_seq', last_id)
+        if not state.hexists('rooms', room_id):
+            state.hset('rooms', room_id, {'created': time.time(), 'empty_since': time.time()})
+
+@app.route('/history')
+def chat_history_page():
+    room_id = normalize_room_id(request.args.get('room'))
+    before = request.args.get('before', type=int)
+    limit = min(max(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 1), MAX_HISTORY_PAGE_SIZE)
+    messages = []
+    if os.path.isdir(os.path.join(CHAT_LOG_FOLDER, room_id)):
+        try:
+            messages = get_chat_log(room_id).read_page(before, limit)
+        except (ValueError, struct.error) as e: # Undecodable records; the live history still works
+            log_event('chat_log_unreadable', room=room_id, reason=str(e))
+    # A full page may have older messages behind it; pass next_before as ?before= to get them
+    next_before = messages[0]['id'] if len(messages) == limit else None
+    body = json.dumps({'room': room_id, 'messages': messages, 'next_before': next_before})
+    return body, 200, {'Content-Type': 'application/json'}
+
+# --- Playback State ---
+# Late joiners get the host's playback state in 'initial_state' and can start at the right
+# position instead of waiting for the host's next periodic seek.
+MAX_CONTROL_AGE = 5.0 # Seconds; older host timestamps are treated as clock errors
+
+def initial_playback_state():
+    return {'playing': False, 'position': 0.0, 'anchor': time.time(), 'rate': 1.0}
+
+def get_playback_state(room):
+    return room.get('playback_state') or initial_playback_state()
+
+def current_playback_position(playback_state, now):
+    if not playback_state['playing']:
+        return playback_state['position']
+    return playback_state['position'] + (now - playback_state['anchor']) * playback_state['rate']
+
+def update_playback_state(room, action, position, rate=None, sent_at=None, playing=None):
+    now = time.time()
+    playback_state = get_playback_state(room)
+    playback_state['position'] = max(0.0, float(position))
+    # Hosts stamp controls with their estimate of server time, which removes their uplink
+    # latency from the anchor. Anything implausible falls back to the arrival time.
+    if isinstance(sent_at, (int, float)) and now - MAX_CONTROL_AGE <= sent_at <= now:
+        playback_state['anchor'] = float(sent_at)
+    else:
+        playback_state['anchor'] = now
+    if isinstance(playing, bool): # The host's own view wins; older clients only imply it
+        playback_state['playing'] = playing
+    elif action == 'play':
+        playback_state['playing'] = True
+    elif action == 'pause':
+        playback_state['playing'] = False
+    if isinstance(rate, (int, float)) and rate > 0:
+        playback_state['rate'] = float(rate)
+    room.set('playback_state', playback_state)
+    return playback_state
+
+def reset_playback_state(room):
+    room.set('playback_state', initial_playback_state())
+
+def playback_sync_payload(playback_state, action):
+    # What viewers get in 'sync_video_playback': the host's state anchored to server time
+    return {
+        'action': action,
+        'time': playback_state['position'],
+        'rate': playback_state['rate'],
+        'playing': playback_state['playing'],
+        'server_time': playback_state['anchor']
+    }
+
+def playback_snapshot(room):
+    now = time.time()
+    playback_state = get_playback_state(room)
+    return {
+        'playing': playback_state['playing'],
+        'position': current_playback_position(playback_state, now),
+        'rate': playback_state['rate'],
+        'server_time': now
+    }
+
+# --- Rate Limiting ---
+# Every limited event has a token bucket per connection: RATE tokens per second up to BURST.
+# Buckets are two floats per (sid, event), kept by the worker that owns the connection.
+# Over the limit, events are dropped; where REJECT_MESSAGE is set the client is told once
+# per run of dropped events. Limits can be overridden with RATE_LIMITS, a JSON object of
+# {"event": [rate, burst]}.
+RATE_LIMITS = {
+    # event: (rate per second, burst, rejection message or None to drop silently)
+    'message': (1.0, 5, 'You are sending messages too fast. Please slow down.'),
+    'authenticate_host': (0.2, 5, 'Too many host login attempts. Please wait a moment.'),
+    'toggle_mute_user': (2.0, 10, 'Too many requests. Please slow down.'),
+    'toggle_chat_enabled': (1.0, 5, 'Too many requests. Please slow down.'),
+    'host_starts_video_share': (1.0, 5, 'Too many requests. Please slow down.'),
+    'host_clears_video': (1.0, 5, 'Too many requests. Please slow down.'),
+    'host_video_control': (4.0, 10, None), # Periodic syncs plus seeks; extra ones are dropped
+    'request_user_list': (1.0, 5, None),
+    'request_initial_state': (1.0, 5, None),
+    'get_my_user_status': (1.0, 5, None),
+    'clock_sync': (2.0, 10, None), # A burst of samples on connect
+    'start_profile': (0.1, 2, 'Too many requests. Please slow down.'),
+}
+for event, (rate, burst) in json.loads(os.environ.get('RATE_LIMITS', '{}')).items():
+    RATE_LIMITS[event] = (float(rate), float(burst), RATE_LIMITS.get(event, (0, 0, None))[2])
+
+rate_buckets = {} # sid -> {event: [tokens, updated_at, rejected]}
+rate_limit_stats = {event: {'allowed': 0, 'limited': 0} for event in RATE_LIMITS}
+
+def take_token(sid, event):
+    rate, burst, _ = RATE_LIMITS[event]
+    now = time.monotonic()
+    bucket = rate_buckets.setdefault(sid, {}).get(event)
+    if bucket is None:
+        bucket = rate_buckets[sid][event] = [float(burst), now, False]
+    else:
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+    if bucket[0] >= 1:
+        bucket[0] -= 1
+        bucket[2] = False
+        return True, False
+    first_rejection = not bucket[2]
+    bucket[2] = True
+    return False, first_rejection
+
+def rate_limited(event):
+    # Wraps a Socket.IO handler (below @socketio.on) so over-limit events never reach it
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            allowed, first_rejection = take_token(request.sid, event)
+            if allowed:
+                rate_limit_stats[event]['allowed'] += 1
+                return handler(*args, **kwargs)
+            rate_limit_stats[event]['limited'] += 1
+            message = RATE_LIMITS[event][2]
+            if message and first_rejection:
+                emit('status', {'msg': message, 'type': 'error'}, room=request.sid)
+            return {'error': 'rate_limited'} # The ack, for clients that passed a callback
+        return wrapper
+    return decorator
+
+@app.route('/rate_limit_stats')
+def rate_limit_stats_route():
+    stats = {'connections': len(rate_buckets), 'events': rate_limit_stats}
+    return json.dumps(stats), 200, {'Content-Type': 'application/json'}
 
 # --- WebSocket Event Handlers ---
 
+def user_permissions(room, sid):
+    # A client's effective permissions. Only the room-wide chat flag is broadcast on change;
+    # this full state goes to individual sids when their own host or mute status changes.
+    chat_enabled = not room.get('chat_disabled_for_all', False)
+    is_host = sid in room.hosts
+    is_muted = sid in room.muted_users
+    return {
+        'is_host': is_host,
+        'is_muted': is_muted,
+        'chat_enabled': chat_enabled,
+        'can_chat': is_host or (chat_enabled and not is_muted)
+    }
+
 @socketio.on('connect')
-def handle_connect():
+@metered('connect')
+def handle_connect(auth=None):
     sid = request.sid
-    print(f"Client connected: {sid}")
-    join_room(CHAT_ROOM)
+    room = enter_room(sid, normalize_room_id(request.args.get('room')))
+    log_event('connect', sid=sid, room=room.id)
+    join_room(room.chat_room)
     # Initialize user_info with default values
-    if sid not in user_info:
-        user_info[sid] = {'username': 'Anonymous', 'is_host': False, 'is_muted': False}
+    if sid not in room.user_info:
+        room.user_info[sid] = {'username': 'Anonymous', 'is_host': False, 'is_muted': False}
     
-    # Send the initial chat_disabled_for_all status to the new user
-    emit('update_chat_status', {'enabled': not chat_disabled_for_all}, room=sid)
+    # Send the new user its permissions, including the room's chat_disabled_for_all status
+    emit('permissions', user_permissions(room, sid), room=sid)
 
-    # For hosts, update the user list immediately on connect
-    for host_sid in hosts:
-        emit('update_user_list', {'users': user_info}, room=host_sid)
+    # Announced to the room and to hosts with the next presence batch
+    queue_presence(room, sid, joined=True)
     
     # Request initial state will be called by client JS
     
 @socketio.on('disconnect')
-def handle_disconnect():
+@metered('disconnect')
+def handle_disconnect(reason=None):
     sid = request.sid
+    rate_buckets.pop(sid, None)
+    room = room_of(sid)
+    if room is None:
+        return
     # Check if the user was a host, and if so, remove them from the hosts set
-    if sid in hosts:
-        hosts.remove(sid)
+    if sid in room.hosts:
+        room.hosts.remove(sid)
     
-    username = user_info.pop(sid, {}).get('username', f'User {sid[:4]}') # Get username before removing
-    print(f"Client disconnected: {sid}")
+    username = room.user_info.pop(sid, {}).get('username', f'User {sid[:4]}') # Get username before removing
+    log_event('disconnect', sid=sid, room=room.id)
     
     # Remove from muted_users if they were muted
-    if sid in muted_users:
-        muted_users.remove(sid)
-
-    # Emit a system message about disconnection
-    emit('status', {'msg': f'{username} has disconnected.', 'type': 'system'}, room=CHAT_ROOM)
+    if sid in room.muted_users:
+        room.muted_users.remove(sid)
+    leave_room_state(sid, room)
 
-    # Update user list for remaining hosts
-    for host_sid in hosts:
-        emit('update_user_list', {'users': user_info}, room=host_sid)
+    # Announce the disconnection and update the hosts' user list with the next presence batch
+    queue_presence(room, sid, joined=False, username=username)
 
 
 @socketio.on('message')
+@metered('message')
+@rate_limited('message')
 def handle_message(data):
     sid = request.sid
-    username = data.get('username', 'Anonymous')
+    room = room_of(sid)
+    if room is None:
+        return
+    username = data.get('username', 'Anonymous')[:MAX_USERNAME_LENGTH]
     message = data.get('message', '')
     
     # Update username in user_info if changed by client
-    if sid in user_info:
-        user_info[sid]['username'] = username
+    user = room.user_info.get(sid)
+    if user is not None and user['username'] != username:
+        user['username'] = username
+        room.user_info[sid] = user
+        if sid not in pending_joins: # A pending join is published with the current name anyway
+            publish_user_list_changes(room, [user_list_change(room, 'update', sid)])
 
-    is_host = sid in hosts
-    is_muted = sid in muted_users
+    is_host = sid in room.hosts
+    is_muted = sid in room.muted_users
 
     if not message.strip():
         emit('status', {'msg': 'Message cannot be empty.', 'type': 'error'}, room=sid)
         return
 
-    if chat_disabled_for_all and not is_host:
+    if len(message) > MAX_MESSAGE_LENGTH:
+        emit('status', {'msg': f'Message is too long (max {MAX_MESSAGE_LENGTH} characters).', 'type': 'error'}, room=sid)
+        return
+
+    if room.get('chat_disabled_for_all', False) and not is_host:
         emit('status', {'msg': 'Chat is currently disabled by the host.', 'type': 'error'}, room=sid)
         return
 
@@ -1056,109 +2620,145 @@ def handle_message(data):
         emit('status', {'msg': 'You are currently muted and cannot send messages.', 'type': 'error'}, room=sid)
         return
 
-    print(f"Message from {username} ({sid}): {message}")
-    emit('new_message', {'username': username, 'message': message}, room=CHAT_ROOM)
+    log_event('message', sid=sid, room=room.id, length=len(message)) # Never the text itself
+    broadcast_chat_message(room, record_chat_message(room, username, message))
 
 
 @socketio.on('authenticate_host')
+@metered('authenticate_host')
+@rate_limited('authenticate_host')
 def authenticate_host(data):
     sid = request.sid
+    room = room_of(sid)
+    if room is None:
+        return
     password = data.get('password')
     if password == HOST_PASSWORD:
-        hosts.add(sid)
-        if sid in user_info:
-            user_info[sid]['is_host'] = True
-        emit('host_authenticated', {'success': True}, room=sid)
-        username = user_info.get(sid, {}).get('username', sid)
-        emit('status', {'msg': f'User {username} is now a host.', 'type': 'system'}, room=CHAT_ROOM)
-        print(f"User {sid} authenticated as host.")
-        for host_sid in hosts:
-            emit('update_user_list', {'users': user_info}, room=host_sid)
+        room.hosts.add(sid)
+        user = room.user_info.get(sid)
+        if user is not None:
+            user['is_host'] = True
+            room.user_info[sid] = user
+            # Tell the existing hosts first; the new host starts from a snapshot that already includes it
+            publish_user_list_changes(room, [user_list_change(room, 'update', sid)])
+        join_room(room.hosts_room)
+        emit('host_authenticated', {'success': True, 'permissions': user_permissions(room, sid)}, room=sid)
+        send_user_list_snapshot(room, sid)
+        username = room.user_info.get(sid, {}).get('username', sid)
+        broadcast('status', {'msg': f'User {username} is now a host.', 'type': 'system'}, room=room.chat_room)
+        log_event('host_authenticated', sid=sid, room=room.id)
     else:
         emit('host_authenticated', {'success': False, 'error': 'Invalid password'}, room=sid)
-        print(f"User {sid} failed host authentication.")
+        log_event('host_authentication_failed', sid=sid, room=room.id)
 
 @socketio.on('toggle_mute_user')
+@metered('toggle_mute_user')
+@rate_limited('toggle_mute_user')
 def toggle_mute_user(data):
     sid = request.sid
-    if sid not in hosts:
+    room = host_room(sid)
+    if room is None:
         emit('status', {'msg': 'Permission denied: Only hosts can mute users.', 'type': 'error'}, room=sid)
         return
 
     target_sid = data.get('target_sid')
-    if target_sid in user_info and target_sid != sid: # Cannot mute self
-        target_username = user_info[target_sid]['username']
-        if target_sid in hosts: # Prevent muting other hosts
+    target_user = room.user_info.get(target_sid) # Only members of the host's own room
+    if target_user is not None and target_sid != sid: # Cannot mute self
+        target_username = target_user['username']
+        if target_sid in room.hosts: # Prevent muting other hosts
             emit('status', {'msg': f'Cannot mute host "{target_username}".', 'type': 'error'}, room=sid)
             return
 
-        if target_sid in muted_users:
-            muted_users.remove(target_sid)
-            user_info[target_sid]['is_muted'] = False
-            emit('status', {'msg': f'User {target_username} has been unmuted by host.', 'type': 'system'}, room=CHAT_ROOM)
-            emit('you_are_unmuted', room=target_sid)
-            print(f"User {target_sid} unmuted by host {user_info.get(sid,{}).get('username',sid)}.")
+        if target_sid in room.muted_users:
+            room.muted_users.remove(target_sid)
+            target_user['is_muted'] = False
+            room.user_info[target_sid] = target_user
+            broadcast('status', {'msg': f'User {target_username} has been unmuted by host.', 'type': 'system'}, room=room.chat_room)
+            emit('you_are_unmuted', user_permissions(room, target_sid), room=target_sid)
+            log_event('user_unmuted', sid=target_sid, host=sid, room=room.id)
         else:
-            muted_users.add(target_sid)
-            user_info[target_sid]['is_muted'] = True
-            emit('status', {'msg': f'User {target_username} has been muted by host.', 'type': 'system'}, room=CHAT_ROOM)
-            emit('you_are_muted', room=target_sid)
-            print(f"User {target_sid} muted by host {user_info.get(sid,{}).get('username',sid)}.")
+            room.muted_users.add(target_sid)
+            target_user['is_muted'] = True
+            room.user_info[target_sid] = target_user
+            broadcast('status', {'msg': f'User {target_username} has been muted by host.', 'type': 'system'}, room=room.chat_room)
+            emit('you_are_muted', user_permissions(room, target_sid), room=target_sid)
+            log_event('user_muted', sid=target_sid, host=sid, room=room.id)
         
-        for host_sid in hosts:
-            emit('update_user_list', {'users': user_info}, room=host_sid)
+        publish_user_list_changes(room, [user_list_change(room, 'update', target_sid)])
     elif target_sid == sid:
         emit('status', {'msg': 'You cannot mute yourself.', 'type': 'error'}, room=sid)
     else:
         emit('status', {'msg': f'User {target_sid} not found or invalid.', 'type': 'error'}, room=sid)
 
 @socketio.on('request_user_list')
+@metered('request_user_list')
+@rate_limited('request_user_list')
 def request_user_list():
     sid = request.sid
-    if sid in hosts:
-        emit('update_user_list', {'users': user_info}, room=sid)
+    room = host_room(sid)
+    if room is not None:
+        send_user_list_snapshot(room, sid)
 
 @socketio.on('toggle_chat_enabled')
+@metered('toggle_chat_enabled')
+@rate_limited('toggle_chat_enabled')
 def toggle_chat_enabled(data):
     sid = request.sid
-    global chat_disabled_for_all
-    if sid not in hosts:
+    room = host_room(sid)
+    if room is None:
         emit('status', {'msg': 'Permission denied: Only hosts can toggle chat.', 'type': 'error'}, room=sid)
         return
     
     # Data.get('enabled') reflects the *new* state (true for enabled, false for disabled)
     new_chat_status = data.get('enabled') 
-    chat_disabled_for_all = not new_chat_status # Invert because our flag means "disabled"
+    room.set('chat_disabled_for_all', not new_chat_status) # Invert because our flag means "disabled"
 
     status_msg = "enabled" if new_chat_status else "disabled"
-    emit('status', {'msg': f'Host has {status_msg} chat for all non-hosts.', 'type': 'system'}, room=CHAT_ROOM)
+    broadcast('status', {'msg': f'Host has {status_msg} chat for all non-hosts.', 'type': 'system'}, room=room.chat_room)
     
-    emit('update_chat_status', {'enabled': new_chat_status}, room=CHAT_ROOM) # Send the client-friendly "enabled" state
+    broadcast('update_chat_status', {'enabled': new_chat_status}, room=room.chat_room) # Send the client-friendly "enabled" state
     
-    # No need to iterate and set chat_disabled in user_info for each user as it's a global flag now.
-    # The client-side 'update_chat_status' listener will handle UI updates.
-
-    for host_sid in hosts:
-        emit('update_user_list', {'users': user_info}, room=host_sid)
+    # No need to iterate and set chat_disabled in user_info for each user as it's a room-wide flag now.
+    # The client-side 'update_chat_status' listener will handle UI updates from its own
+    # host/mute state, so a toggle is one broadcast and no per-client round-trips.
+    # user_info is unchanged too, so hosts need no user list update.
 
 @socketio.on('request_initial_state')
-def request_initial_state():
+@metered('request_initial_state')
+@rate_limited('request_initial_state')
+def request_initial_state(data=None):
     sid = request.sid
-    video_url_to_send = None
-    if current_shared_video_server_path:
-        video_url_to_send = f"/videos/{os.path.basename(current_shared_video_server_path)}"
+    room = room_of(sid)
+    if room is None:
+        return
+    current_video = room.get('current_video')
+    video_url_to_send = current_video['url'] if current_video else None
+    # 'since' is the last message id the client has; omitted on a fresh page load
+    history, history_complete, history_reset = chat_history(room, (data or {}).get('since'))
         
     emit('initial_state', {
-        'chat_enabled': not chat_disabled_for_all,
+        'room': room.id,
+        'history': history,
+        'history_complete': history_complete,
+        'history_reset': history_reset,
+        'chat_enabled': not room.get('chat_disabled_for_all', False),
         'current_video_url': video_url_to_send,
+        'playback': playback_snapshot(room) if video_url_to_send else None,
+        'video_metadata': current_video['metadata'] if current_video else None,
+        'permissions': user_permissions(room, sid),
         'is_host_password_set': bool(HOST_PASSWORD) # Indicate if host password is set for UI
     }, room=sid)
 
 @socketio.on('get_my_user_status')
-def get_my_user_status(data, callback): # Added callback argument
+@metered('get_my_user_status')
+@rate_limited('get_my_user_status')
+def get_my_user_status(data=None):
+    # Kept for older clients; current ones are pushed 'permissions' instead of asking.
+    # The return value is the acknowledgement the client's callback receives.
     sid = request.sid
-    status = user_info.get(sid, {'username': 'Anonymous', 'is_host': False, 'is_muted': False})
-    callback(status) # Use the callback to send status back to the client
+    room = room_of(sid)
+    status = room.user_info.get(sid) if room is not None else None
+    return status or {'username': 'Anonymous', 'is_host': False, 'is_muted': False}
 
 # --- Video Sharing Backend (Server-Relayed) ---
 
@@ -1166,10 +2766,17 @@ def get_my_user_status(data, callback): # Added callback argument
 def upload_video():
     # Simple check for host status via SID in query param for HTTP endpoint
     # A more robust solution for production would use Flask-Login or similar for session management.
+    started = time.perf_counter()
     requester_sid = request.args.get('sid')
-    if requester_sid not in hosts:
+    room = host_room(requester_sid)
+    if room is None:
         return json.dumps({'success': False, 'error': 'Permission denied: Not a host'}), 403
 
+    # A raw (non-multipart) body is streamed straight to disk; multipart forms use the
+    # original werkzeug path, which spools the file once before saving it.
+    if request.mimetype != 'multipart/form-data':
+        return upload_video_stream(room, started)
+
     if 'video' not in request.files:
         return json.dumps({'success': False, 'error': 'No video file provided'}), 400
 
@@ -1178,36 +2785,924 @@ def upload_video():
         return json.dumps({'success': False, 'error': 'No selected file'}), 400
 
     if video_file:
-        global current_shared_video_server_path
-        # Clear existing uploads before saving new one
-        # This is a simple approach. For production, consider proper file management
-        # to avoid race conditions or accidental deletion of needed files.
-        if os.path.exists(UPLOAD_FOLDER):
-            # Ensure the directory is empty but exists
-            for item in os.listdir(UPLOAD_FOLDER):
-                item_path = os.path.join(UPLOAD_FOLDER, item)
-                if os.path.isfile(item_path):
-                    os.unlink(item_path)
-                elif os.path.isdir(item_path):
-                    shutil.rmtree(item_path)
-        else:
-            os.makedirs(UPLOAD_FOLDER)
-
-        # Sanitize filename to prevent directory traversal attacks
-        filename = secure_filename(video_file.filename)
-        # Add a unique prefix to prevent name collisions
-        filename = f"shared_video_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}_{filename}"
-        file_path = os.path.join(UPLOAD_FOLDER, filename)
-        video_file.save(file_path)
-        current_shared_video_server_path = file_path
-        
-        video_url = f"/videos/{filename}"
+        # Saved beside the store first; the store then keeps one copy per distinct content
+        partial_path = os.path.join(PARTIAL_UPLOAD_FOLDER, secrets.token_hex(16))
+        video_file.save(partial_path)
+        sha256, size = hash_file(partial_path)
+        record_upload('multipart', size, started)
+        store_video(partial_path, sha256, size, video_file.filename)
+        set_shared_video(room, sha256)
+
+        video_url = video_url_for(sha256)
         return json.dumps({'success': True, 'video_url': video_url}), 200
     
     return json.dumps({'success': False, 'error': 'Unknown error during upload'}), 500
 
+def receive_upload_stream(stream, path, expected_size=None):
+    # Copy the request body to path in chunks, hashing as it arrives.
+    # Returns (sha256, size), or None after deleting the partial file if the stream was cut
+    # short or grew past MAX_UPLOAD_BYTES.
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        with open(path, 'wb') as f:
+            while True:
+                data = stream.read(UPLOAD_READ_SIZE)
+                if not data:
+                    break
+                size += len(data)
+                if size > MAX_UPLOAD_BYTES:
+                    raise ValueError('Upload exceeds the maximum size')
+                hasher.update(data)
+                f.write(data)
+        if expected_size is not None and size != expected_size:
+            raise ValueError('Upload ended early')
+    except Exception as e:
+        log_event('upload_aborted', path=path, reason=str(e))
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return None
+    return hasher.hexdigest(), size
+
+def upload_video_stream(room, started):
+    if request.content_length is not None and request.content_length > MAX_UPLOAD_BYTES:
+        return json.dumps({'success': False, 'error': 'Video is too large'}), 413
+    original_filename = request.args.get('filename', '')
+    if not original_filename:
+        return json.dumps({'success': False, 'error': 'No selected file'}), 400
+
+    # Written next to UPLOAD_FOLDER and renamed into the store, so no byte is copied twice
+    partial_path = os.path.join(PARTIAL_UPLOAD_FOLDER, secrets.token_hex(16))
+    received = receive_upload_stream(request.stream, partial_path, request.content_length)
+    if received is None:
+        return json.dumps({'success': False, 'error': 'Upload was interrupted or too large'}), 400
+    sha256, size = received
+    record_upload('stream', size, started) # Before faststart and hashing into the store
+    store_video(partial_path, sha256, size, original_filename)
+    set_shared_video(room, sha256)
+
+    return json.dumps({'success': True, 'video_url': video_url_for(sha256), 'sha256': sha256, 'size': size}), 200
+
+# --- MP4 Faststart ---
+# Many MP4s have their 'moov' box (the index of all samples) after the media data, so every
+# viewer's player has to fetch the end of the file before it can start. After upload the box
+# is moved in front of the first 'mdat' and the chunk offsets in 'stco'/'co64' are shifted to
+# match. Media data is copied in fixed-size chunks; only 'moov' itself is held in memory.
+MP4_CONTAINER_BOXES = {b'moov', b'trak', b'mdia', b'minf', b'stbl'} # The path down to stco/co64
+
+def iter_mp4_boxes(f, start, end):
+    # Yields (box_type, box_start, header_size, box_end) for the boxes in f[start:end]
+    position = start
+    while position + 8 <= end:
+        f.seek(position)
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        header_size = 8
+        if size == 1: # 64-bit size follows the type
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif size == 0: # Box extends to the end of its parent
+            size = end - position
+        if size < header_size or position + size > end:
+            raise ValueError(f'Malformed MP4 box at offset {position}')
+        yield box_type, position, header_size, position + size
+        position += size
+
+def patch_chunk_offsets(moov, start, end, shift_offset):
+    # Rewrites every stco/co64 entry in the in-memory moov (a BytesIO) through shift_offset
+    for box_type, box_start, header_size, box_end in list(iter_mp4_boxes(moov, start, end)):
+        body = box_start + header_size
+        if box_type in MP4_CONTAINER_BOXES:
+            patch_chunk_offsets(moov, body, box_end, shift_offset)
+        elif box_type == b'cmov':
+            raise ValueError('Compressed moov boxes are not supported')
+        elif box_type in (b'stco', b'co64'):
+            code = 'I' if box_type == b'stco' else 'Q'
+            moov.seek(body + 4) # Skip version and flags
+            count = struct.unpack('>I', moov.read(4))[0]
+            if body + 8 + count * struct.calcsize(code) > box_end:
+                raise ValueError('Chunk offset table overruns its box')
+            offsets = [shift_offset(offset) for offset in struct.unpack(f'>{count}{code}', moov.read(count * struct.calcsize(code)))]
+            if code == 'I' and offsets and max(offsets) > 0xFFFFFFFF:
+                raise OverflowError('Shifted offsets no longer fit in stco')
+            moov.seek(body + 8)
+            moov.write(struct.pack(f'>{count}{code}', *offsets))
+
+def copy_byte_range(src, dst, start, end):
+    src.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        data = src.read(min(UPLOAD_READ_SIZE, remaining))
+        if not data:
+            raise IOError('Unexpected end of file')
+        dst.write(data)
+        remaining -= len(data)
+        socketio.sleep(0) # Let other clients be served during a multi-GB copy
+
+def mp4_faststart(src_path, dst_path):
+    # Writes a faststart copy of src_path to dst_path and returns True, or returns False
+    # (writing nothing) when the file is not an MP4 or already has 'moov' up front
+    size = os.path.getsize(src_path)
+    with open(src_path, 'rb') as src:
+        try:
+            boxes = list(iter_mp4_boxes(src, 0, size))
+        except (ValueError, struct.error):
+            return False
+        types = [box[0] for box in boxes]
+        if not types or types[0] != b'ftyp' or b'moov' not in types or b'mdat' not in types:
+            return False
+        moov_index, first_mdat = types.index(b'moov'), types.index(b'mdat')
+        if moov_index < first_mdat:
+            return False
+
+        _, moov_start, _, moov_end = boxes[moov_index]
+        insert_at = boxes[first_mdat][1]
+        moov_size = moov_end - moov_start
+        src.seek(moov_start)
+        moov = io.BytesIO(src.read(moov_size))
+
+        # Only data between the insertion point and the old moov position moves
+        def shift_offset(offset):
+            return offset + moov_size if insert_at <= offset < moov_start else offset
+        try:
+            patch_chunk_offsets(moov, 0, moov_size, shift_offset)
+        except (ValueError, OverflowError, struct.error) as e:
+            log_event('faststart_skipped', path=src_path, reason=str(e))
+            return False
+
+        try:
+            with open(dst_path, 'wb') as dst:
+                copy_byte_range(src, dst, 0, insert_at)
+                dst.write(moov.getvalue())
+                copy_byte_range(src, dst, insert_at, moov_start)
+                copy_byte_range(src, dst, moov_end, size)
+        except IOError as e:
+            log_event('faststart_failed', path=src_path, reason=str(e))
+            remove_path(dst_path)
+            return False
+    return True
+
+# --- Media Metadata ---
+# Stored videos get a metadata record (MIME type, duration, bitrate, dimensions, track codecs)
+# parsed from the MP4 box tree or the Matroska/WebM EBML header. Only the index structures
+# are read, never the media data. The record picks the Content-Type in serve_video and is
+# sent to clients with initial_state.
+MAX_INDEX_READ_BYTES = 64 * 1024 * 1024 # Refuse to load absurdly large moov/Tracks elements
+MP4_HANDLER_TYPES = {b'vide': 'video', b'soun': 'audio', b'text': 'text', b'sbtl': 'text', b'subt': 'text'}
+
+EBML_HEADER_ID = 0x1A45DFA3
+EBML_DOCTYPE_ID = 0x4282
+MKV_SEGMENT_ID = 0x18538067
+MKV_INFO_ID = 0x1549A966
+MKV_TIMECODE_SCALE_ID = 0x2AD7B1
+MKV_DURATION_ID = 0x4489
+MKV_TRACKS_ID = 0x1654AE6B
+MKV_TRACK_ENTRY_ID = 0xAE
+MKV_TRACK_TYPE_ID = 0x83
+MKV_CODEC_ID = 0x86
+MKV_VIDEO_ID = 0xE0
+MKV_PIXEL_WIDTH_ID = 0xB0
+MKV_PIXEL_HEIGHT_ID = 0xBA
+MKV_CLUSTER_ID = 0x1F43B675
+MKV_TRACK_TYPES = {1: 'video', 2: 'audio', 17: 'text'}
+
+def find_mp4_box(f, start, end, path):
+    # Follows a list of box types down the tree; returns (body_start, box_end) or None
+    for box_type in path:
+        for found_type, box_start, header_size, box_end in iter_mp4_boxes(f, start, end):
+            if found_type == box_type:
+                start, end = box_start + header_size, box_end
+                break
+        else:
+            return None
+    return start, end
+
+def mp4_metadata(f, size):
+    top_level = {}
+    for box_type, box_start, header_size, box_end in iter_mp4_boxes(f, 0, size):
+        top_level.setdefault(box_type, (box_start + header_size, box_end))
+    f.seek(top_level[b'ftyp'][0])
+    major_brand = f.read(4)
+    metadata = {'container': 'quicktime' if major_brand == b'qt  ' else 'mp4', 'tracks': []}
+    if b'moov' not in top_level:
+        return metadata
+
+    moov_start, moov_end = top_level[b'moov']
+    if moov_end - moov_start > MAX_INDEX_READ_BYTES:
+        return metadata
+    f.seek(moov_start)
+    moov = io.BytesIO(f.read(moov_end - moov_start))
+    moov_size = moov_end - moov_start
+
+    mvhd = find_mp4_box(moov, 0, moov_size, [b'mvhd'])
+    if mvhd:
+        moov.seek(mvhd[0])
+        version = moov.read(4)[0]
+        if version == 1:
+            moov.seek(16, io.SEEK_CUR)
+            timescale, duration = struct.unpack('>IQ', moov.read(12))
+        else:
+            moov.seek(8, io.SEEK_CUR)
+            timescale, duration = struct.unpack('>II', moov.read(8))
+        if timescale:
+            metadata['duration'] = duration / timescale
+
+    for box_type, box_start, header_size, box_end in iter_mp4_boxes(moov, 0, moov_size):
+        if box_type != b'trak':
+            continue
+        trak_start = box_start + header_size
+        track = {'type': 'other', 'codec': None}
+        hdlr = find_mp4_box(moov, trak_start, box_end, [b'mdia', b'hdlr'])
+        if hdlr:
+            moov.seek(hdlr[0] + 8) # version/flags and pre_defined
+            track['type'] = MP4_HANDLER_TYPES.get(moov.read(4), 'other')
+        stsd = find_mp4_box(moov, trak_start, box_end, [b'mdia', b'minf', b'stbl', b'stsd'])
+        if stsd:
+            moov.seek(stsd[0] + 12) # version/flags, entry count and the first entry's size
+            track['codec'] = moov.read(4).decode('ascii', 'replace')
+        tkhd = find_mp4_box(moov, trak_start, box_end, [b'tkhd'])
+        if tkhd and track['type'] == 'video':
+            moov.seek(tkhd[0])
+            version = moov.read(4)[0]
+            # Width and height are the last two 16.16 fixed-point fields
+            moov.seek(tkhd[0] + (88 if version == 1 else 76))
+            width, height = struct.unpack('>II', moov.read(8))
+            track['width'], track['height'] = width >> 16, height >> 16
+        metadata['tracks'].append(track)
+    return metadata
+
+def read_ebml_vint(f, keep_marker=False):
+    # Returns (value, length, is_unknown_size); element IDs keep their length marker bits
+    first = f.read(1)
+    if not first:
+        raise ValueError('Unexpected end of EBML data')
+    length, mask = 1, 0x80
+    while length <= 8 and not first[0] & mask:
+        length += 1
+        mask >>= 1
+    if length > 8:
+        raise ValueError('Invalid EBML variable-length integer')
+    rest = f.read(length - 1)
+    if len(rest) != length - 1:
+        raise ValueError('Unexpected end of EBML data')
+    value = first[0] if keep_marker else first[0] & (mask - 1)
+    for byte in rest:
+        value = (value << 8) | byte
+    return value, length, not keep_marker and value == (1 << (7 * length)) - 1
+
+def iter_ebml_elements(f, start, end):
+    # Yields (element_id, data_start, data_end); stops after an element of unknown size
+    position = start
+    while position < end:
+        f.seek(position)
+        element_id, id_length, _ = read_ebml_vint(f, keep_marker=True)
+        size, size_length, unknown_size = read_ebml_vint(f)
+        data_start = position + id_length + size_length
+        data_end = end if unknown_size else min(data_start + size, end)
+        yield element_id, data_start, data_end
+        if unknown_size:
+            return
+        position = data_end
+
+def read_ebml_value(f, data_start, data_end, kind):
+    f.seek(data_start)
+    data = f.read(data_end - data_start)
+    if kind == 'uint':
+        return int.from_bytes(data, 'big')
+    if kind == 'float':
+        return struct.unpack('>f' if len(data) == 4 else '>d', data)[0] if len(data) in (4, 8) else None
+    return data.rstrip(b'\0').decode('ascii', 'replace')
+
+def ebml_metadata(f, size):
+    metadata = {'container': 'matroska', 'tracks': []}
+    segment = None
+    for element_id, data_start, data_end in iter_ebml_elements(f, 0, size):
+        if element_id == EBML_HEADER_ID:
+            for child_id, child_start, child_end in iter_ebml_elements(f, data_start, data_end):
+                if child_id == EBML_DOCTYPE_ID and read_ebml_value(f, child_start, child_end, 'str') == 'webm':
+                    metadata['container'] = 'webm'
+        elif element_id == MKV_SEGMENT_ID:
+            segment = (data_start, data_end)
+            break
+    if segment is None:
+        return metadata
+
+    timecode_scale, duration = 1000000, None # Matroska default scale: 1 ms per tick
+    for element_id, data_start, data_end in iter_ebml_elements(f, *segment):
+        if element_id == MKV_CLUSTER_ID:
+            break # Media data starts here; everything we need comes before it
+        if data_end - data_start > MAX_INDEX_READ_BYTES:
+            continue
+        if element_id == MKV_INFO_ID:
+            for child_id, child_start, child_end in iter_ebml_elements(f, data_start, data_end):
+                if child_id == MKV_TIMECODE_SCALE_ID:
+                    timecode_scale = read_ebml_value(f, child_start, child_end, 'uint')
+                elif child_id == MKV_DURATION_ID:
+                    duration = read_ebml_value(f, child_start, child_end, 'float')
+        elif element_id == MKV_TRACKS_ID:
+            for entry_id, entry_start, entry_end in iter_ebml_elements(f, data_start, data_end):
+                if entry_id != MKV_TRACK_ENTRY_ID:
+                    continue
+                track = {'type': 'other', 'codec': None}
+                for child_id, child_start, child_end in iter_ebml_elements(f, entry_start, entry_end):
+                    if child_id == MKV_TRACK_TYPE_ID:
+                        track['type'] = MKV_TRACK_TYPES.get(read_ebml_value(f, child_start, child_end, 'uint'), 'other')
+                    elif child_id == MKV_CODEC_ID:
+                        track['codec'] = read_ebml_value(f, child_start, child_end, 'str')
+                    elif child_id == MKV_VIDEO_ID:
+                        for video_id, video_start, video_end in iter_ebml_elements(f, child_start, child_end):
+                            if video_id == MKV_PIXEL_WIDTH_ID:
+                                track['width'] = read_ebml_value(f, video_start, video_end, 'uint')
+                            elif video_id == MKV_PIXEL_HEIGHT_ID:
+                                track['height'] = read_ebml_value(f, video_start, video_end, 'uint')
+                metadata['tracks'].append(track)
+    if duration is not None:
+        metadata['duration'] = duration * timecode_scale / 1e9
+    return metadata
+
+def container_mime_type(metadata):
+    # Audio only when every track is audio; unknown or text-only tracks count as video
+    audio_only = metadata['tracks'] and all(track['type'] == 'audio' for track in metadata['tracks'])
+    kind = 'audio' if audio_only else 'video'
+    if metadata['container'] == 'quicktime':
+        return 'video/quicktime'
+    if metadata['container'] == 'mp4':
+        return f'{kind}/mp4'
+    if metadata['container'] == 'webm':
+        return f'{kind}/webm'
+    return f'{kind}/x-matroska'
+
+def extract_video_metadata(path, original_name):
+    size = os.path.getsize(path)
+    metadata = {'container': None, 'tracks': []}
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(8)
+            if head[4:8] == b'ftyp':
+                metadata = mp4_metadata(f, size)
+            elif head[:4] == EBML_HEADER_ID.to_bytes(4, 'big'):
+                metadata = ebml_metadata(f, size)
+    except (ValueError, KeyError, IndexError, struct.error) as e:
+        log_event('metadata_unreadable', path=path, reason=str(e))
+
+    if metadata['container']:
+        metadata['mime_type'] = container_mime_type(metadata)
+    else:
+        metadata['mime_type'] = mimetypes.guess_type(original_name)[0] or 'video/mp4'
+    duration = metadata.setdefault('duration', None)
+    metadata['bitrate'] = int(size * 8 / duration) if duration else None
+    video_tracks = [track for track in metadata['tracks'] if track['type'] == 'video' and 'width' in track]
+    metadata['width'] = video_tracks[0]['width'] if video_tracks else None
+    metadata['height'] = video_tracks[0]['height'] if video_tracks else None
+    return metadata
+
+# --- Content-Addressed Video Store ---
+# Each distinct video is stored once, as UPLOAD_FOLDER/<sha256><ext>. Sharing a video holds a
+# reference to it; unreferenced videos are evicted least recently used first once the store
+# grows past VIDEO_STORE_BYTES. The index survives restarts in UPLOAD_FOLDER/index.json.
+VIDEO_STORE_BYTES = int(os.environ.get('VIDEO_STORE_BYTES', 20 * 1024 * 1024 * 1024))
+VIDEO_INDEX_PATH = os.path.join(UPLOAD_FOLDER, 'index.json')
+FINGERPRINT_SAMPLE_BYTES = 1024 * 1024
+
+# Workers sharing UPLOAD_FOLDER coordinate through an flock on VIDEO_INDEX_LOCK_PATH and reload
+# the index whenever another worker has rewritten it. Share refcounts live in the state backend.
+VIDEO_INDEX_LOCK_PATH = VIDEO_INDEX_PATH + '.lock'
+
+video_index = {} # sha256 -> {'filename', 'size', 'original_name', 'fingerprint', 'faststart', 'metadata', 'last_used'}
+video_index_mtime = None # mtime_ns of the index file video_index was loaded from
+# state hash 'video_refs': sha256 -> active shares
+
+def remove_path(item_path):
+    try:
+        if os.path.isfile(item_path) or os.path.islink(item_path):
+            os.unlink(item_path)
+        elif os.path.isdir(item_path):
+            shutil.rmtree(item_path)
+    except Exception as e:
+        log_event('delete_failed', path=item_path, reason=str(e))
+
+def hash_file(path):
+    hasher = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(UPLOAD_READ_SIZE), b''):
+            hasher.update(data)
+            size += len(data)
+            socketio.sleep(0) # Let other clients be served while a multi-GB file is hashed
+    return hasher.hexdigest(), size
+
+def file_fingerprint(path, size):
+    # A cheap identity hint the browser can compute before uploading anything:
+    # SHA-256 over the decimal size, the first MiB and the last MiB
+    hasher = hashlib.sha256(str(size).encode())
+    with open(path, 'rb') as f:
+        hasher.update(f.read(FINGERPRINT_SAMPLE_BYTES))
+        if size > FINGERPRINT_SAMPLE_BYTES:
+            f.seek(max(FINGERPRINT_SAMPLE_BYTES, size - FINGERPRINT_SAMPLE_BYTES))
+            hasher.update(f.read())
+    return hasher.hexdigest()
+
+def save_video_index():
+    global video_index_mtime
+    tmp_path = VIDEO_INDEX_PATH + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(video_index, f)
+    os.replace(tmp_path, VIDEO_INDEX_PATH)
+    video_index_mtime = os.stat(VIDEO_INDEX_PATH).st_mtime_ns
+
+def refresh_video_index():
+    # Cheap when nothing changed: one stat. os.replace keeps readers from seeing a partial file.
+    global video_index_mtime
+    try:
+        mtime = os.stat(VIDEO_INDEX_PATH).st_mtime_ns
+        if mtime == video_index_mtime:
+            return
+        with open(VIDEO_INDEX_PATH) as f:
+            loaded = json.load(f)
+    except (OSError, ValueError):
+        return
+    video_index.clear()
+    video_index.update(loaded)
+    video_index_mtime = mtime
+
+@contextmanager
+def locked_video_index():
+    # Read-modify-write of the index (and of the share refcounts) across workers
+    with open(VIDEO_INDEX_LOCK_PATH, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            refresh_video_index()
+            yield
+            save_video_index()
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def load_video_index():
+    with locked_video_index():
+        # Forget entries whose file is gone and delete files the index does not know about
+        # (including videos uploaded before the store existed)
+        known = {os.path.basename(path) for path in (VIDEO_INDEX_PATH, VIDEO_INDEX_LOCK_PATH, VIDEO_INDEX_PATH + '.tmp')}
+        for sha256, entry in list(video_index.items()):
+            stored_path = os.path.join(UPLOAD_FOLDER, entry['filename'])
+            if os.path.isfile(stored_path):
+                known.add(entry['filename'])
+                if 'metadata' not in entry: # Stored before metadata extraction existed
+                    entry['metadata'] = extract_video_metadata(stored_path, entry['original_name'])
+            else:
+                del video_index[sha256]
+        for item in os.listdir(UPLOAD_FOLDER):
+            if item not in known:
+                remove_path(os.path.join(UPLOAD_FOLDER, item))
+
+def store_video(path, sha256, size, original_name):
+    # Moves a fully received upload into the store; content we already have is just dropped
+    refresh_video_index()
+    entry = None
+    if sha256 not in video_index:
+        extension = os.path.splitext(secure_filename(original_name))[1].lower()[:10]
+        entry = {
+            'filename': f'{sha256}{extension}',
+            'size': size,
+            'original_name': original_name,
+            'fingerprint': file_fingerprint(path, size)
+        }
+        # Still keyed by the uploaded content's hash, so re-uploading the original dedupes.
+        # Prepared next to the upload and outside the index lock, since faststart copies the file.
+        prepared_path = path + '.faststart'
+        entry['faststart'] = mp4_faststart(path, prepared_path)
+        if entry['faststart']:
+            os.unlink(path)
+            path = prepared_path
+        entry['metadata'] = extract_video_metadata(path, original_name)
+
+    with locked_video_index():
+        if sha256 in video_index: # Stored already, possibly by another worker meanwhile
+            os.unlink(path)
+        else:
+            os.replace(path, os.path.join(UPLOAD_FOLDER, entry['filename']))
+            video_index[sha256] = entry
+        video_index[sha256]['last_used'] = time.time()
+
+def evict_videos():
+    # Called with the index locked
+    refs = state.hgetall('video_refs')
+    total = sum(entry['size'] for entry in video_index.values())
+    for sha256, entry in sorted(video_index.items(), key=lambda item: item[1]['last_used']):
+        if total <= VIDEO_STORE_BYTES:
+            break
+        if refs.get(sha256):
+            continue # Still being watched
+        remove_path(os.path.join(UPLOAD_FOLDER, entry['filename']))
+        del video_index[sha256]
+        total -= entry['size']
+
+def set_shared_video(room, sha256):
+    # Moves the room's shared-video reference to sha256 (or drops it for None)
+    with locked_video_index():
+        previous = room.get('current_video')
+        if previous is not None:
+            refs = (state.hget('video_refs', previous['sha256']) or 0) - 1
+            if refs > 0:
+                state.hset('video_refs', previous['sha256'], refs)
+            else:
+                state.hdel('video_refs', previous['sha256'])
+                discard_cached_video(previous['path'])
+
+        if sha256 is None:
+            room.set('current_video', None)
+        else:
+            state.hset('video_refs', sha256, (state.hget('video_refs', sha256) or 0) + 1)
+            entry = video_index[sha256]
+            entry['last_used'] = time.time()
+            room.set('current_video', {
+                'sha256': sha256,
+                'path': os.path.join(UPLOAD_FOLDER, entry['filename']),
+                'url': f"/videos/{entry['filename']}",
+                'metadata': entry.get('metadata')
+            })
+
+        evict_videos()
+
+def discard_cached_video(path):
+    # Nobody is watching it any more, so its blocks would only crowd out live videos.
+    # Only this worker's cache is cleared; the others age the blocks out of their LRU.
+    try:
+        video_cache.discard_video(video_validators(os.stat(path))[0]) # Blocks are keyed by ETag
+    except OSError:
+        pass
+
+def video_url_for(sha256):
+    refresh_video_index()
+    return f"/videos/{video_index[sha256]['filename']}"
+
+def is_stored_video(filename):
+    # Only store entries are public; index.json and its lock file share the folder
+    refresh_video_index()
+    entry = video_index.get(filename[:64])
+    return bool(entry) and entry['filename'] == filename
+
+def stored_video_metadata(filename):
+    # Stored filenames are '<sha256><ext>'
+    refresh_video_index()
+    entry = video_index.get(filename[:64])
+    return entry.get('metadata') if entry and entry['filename'] == filename else None
+
+def find_stored_video(sha256=None, size=None, fingerprint=None):
+    refresh_video_index()
+    if sha256 in video_index:
+        return sha256
+    if fingerprint:
+        for candidate, entry in video_index.items():
+            if entry['size'] == size and entry['fingerprint'] == fingerprint:
+                return candidate
+    return None
+
+@app.route('/video_lookup', methods=['POST'])
+def video_lookup():
+    # Lets the host skip the upload entirely when the store already has the video
+    room = host_room(request.args.get('sid'))
+    if room is None:
+        return json.dumps({'success': False, 'error': 'Permission denied: Not a host'}), 403
+
+    data = request.get_json(silent=True) or {}
+    sha256 = find_stored_video(data.get('sha256'), data.get('size'), data.get('fingerprint'))
+    if sha256 is None:
+        return json.dumps({'success': True, 'found': False}), 200
+
+    set_shared_video(room, sha256)
+    return json.dumps({'success': True, 'found': True, 'video_url': video_url_for(sha256), 'sha256': sha256}), 200
+
+# --- Resumable Uploads ---
+# Large videos are uploaded in chunks: create the upload, PUT chunks at any offset (in
+# parallel, in any order), check status to resume after a failure, then finalize.
+# Chunks are written in place into a preallocated file, so finalizing is just a rename.
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024 # Suggested client chunk size
+UPLOAD_READ_SIZE = 256 * 1024
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 8 * 1024 * 1024 * 1024))
+# Also caps every request body, so oversized requests are refused before they are read
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+RESUMABLE_UPLOAD_TTL = 6 * 60 * 60 # Seconds without activity before an upload is abandoned
+
+# Upload records are shared, so chunks of one upload may land on different workers. Received
+# ranges are kept as a backend set per upload (one member per chunk) and merged on read,
+# which needs no read-modify-write.
+resumable_uploads = SharedDict(state, 'resumable_uploads') # upload_id -> {'filename', 'size', 'path', 'touched'}
+upload_hashers = {} # upload_id -> {'hasher', 'hashed_offset'}; per worker, finalize hashes what it missed
+
+def upload_ranges_key(upload_id):
+    return f'upload_ranges:{upload_id}'
+
+def discard_resumable_upload(upload_id):
+    resumable_uploads.pop(upload_id)
+    upload_hashers.pop(upload_id, None)
+    for member in state.smembers(upload_ranges_key(upload_id)):
+        state.srem(upload_ranges_key(upload_id), member)
+
+def expire_resumable_uploads():
+    cutoff = time.time() - RESUMABLE_UPLOAD_TTL
+    for upload_id, upload in resumable_uploads.snapshot().items():
+        if upload['touched'] < cutoff:
+            discard_resumable_upload(upload_id)
+    # Also catches partial files whose worker died before recording or finishing them
+    for item in os.listdir(PARTIAL_UPLOAD_FOLDER):
+        path = os.path.join(PARTIAL_UPLOAD_FOLDER, item)
+        try:
+            if os.stat(path).st_mtime < cutoff:
+                os.unlink(path)
+        except OSError:
+            pass
+
+def add_received_range(ranges, start, end):
+    # Keep a sorted list of disjoint [start, end) ranges
+    merged = []
+    for range_start, range_end in sorted(ranges + [[start, end]]):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], range_end)
+        else:
+            merged.append([range_start, range_end])
+    return merged
+
+def received_ranges(upload_id):
+    ranges = []
+    for member in state.smembers(upload_ranges_key(upload_id)):
+        start, end = json.loads(member)
+        ranges = add_received_range(ranges, start, end)
+    return ranges
+
+def advance_upload_hash(upload_id, upload, confirmed_offset):
+    # Hash the newly contiguous prefix while it is still in the page cache, so finalizing
+    # only has to hash whatever arrived last
+    progress = upload_hashers.setdefault(upload_id, {'hasher': hashlib.sha256(), 'hashed_offset': 0})
+    with open(upload['path'], 'rb') as f:
+        while progress['hashed_offset'] < confirmed_offset:
+            # Another request may have advanced the hash while this one yielded
+            f.seek(progress['hashed_offset'])
+            data = f.read(min(UPLOAD_READ_SIZE, confirmed_offset - progress['hashed_offset']))
+            if not data:
+                break
+            progress['hasher'].update(data)
+            progress['hashed_offset'] += len(data)
+            socketio.sleep(0) # A whole file can become contiguous at once (chunk 0 last, resume)
+    return progress['hasher']
+
+def upload_status(upload_id, upload):
+    ranges = received_ranges(upload_id)
+    received = sum(end - start for start, end in ranges)
+    # Everything before confirmed_offset is on disk; a client resumes from there
+    confirmed_offset = ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+    return {
+        'upload_id': upload_id,
+        'size': upload['size'],
+        'received': received,
+        'confirmed_offset': confirmed_offset,
+        'ranges': ranges,
+        'complete': received == upload['size']
+    }
+
+def get_host_upload(upload_id):
+    # Any host may continue an upload: a flaky connection gives the uploader a new sid
+    if host_room(request.args.get('sid')) is None:
+        return None, (json.dumps({'success': False, 'error': 'Permission denied: Not a host'}), 403)
+    upload = resumable_uploads.get(upload_id)
+    if upload is None:
+        return None, (json.dumps({'success': False, 'error': 'Unknown upload'}), 404)
+    upload['touched'] = time.time()
+    resumable_uploads[upload_id] = upload
+    return upload, None
+
+@app.route('/uploads', methods=['POST'])
+def create_resumable_upload():
+    if host_room(request.args.get('sid')) is None:
+        return json.dumps({'success': False, 'error': 'Permission denied: Not a host'}), 403
+
+    data = request.get_json(silent=True) or {}
+    size = data.get('size')
+    if not isinstance(size, int) or size <= 0:
+        return json.dumps({'success': False, 'error': 'A positive file size is required'}), 400
+    if size > MAX_UPLOAD_BYTES:
+        return json.dumps({'success': False, 'error': 'Video is too large'}), 413
+
+    expire_resumable_uploads()
+    upload_id = secrets.token_hex(16)
+    path = os.path.join(PARTIAL_UPLOAD_FOLDER, upload_id)
+    with open(path, 'wb') as f:
+        f.truncate(size) # Sparse preallocation; chunks fill it in place
+    resumable_uploads[upload_id] = {
+        'filename': data.get('filename') or 'video',
+        'size': size,
+        'path': path,
+        'touched': time.time()
+    }
+    return json.dumps({'success': True, 'upload_id': upload_id, 'chunk_size': UPLOAD_CHUNK_SIZE}), 201
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def put_upload_chunk(upload_id):
+    started = time.perf_counter()
+    upload, error = get_host_upload(upload_id)
+    if error:
+        return error
+
+    offset = request.args.get('offset', type=int)
+    if offset is None or offset < 0 or offset >= upload['size']:
+        return json.dumps({'success': False, 'error': 'Invalid offset'}), 400
+    if request.content_length is not None and offset + request.content_length > upload['size']:
+        return json.dumps({'success': False, 'error': 'Chunk extends past the declared size'}), 400
+
+    # Whatever arrives is recorded, so a chunk cut off mid-way only needs its tail resent
+    written = 0
+    fd = os.open(upload['path'], os.O_WRONLY)
+    try:
+        while offset + written < upload['size']:
+            data = request.stream.read(min(UPLOAD_READ_SIZE, upload['size'] - offset - written))
+            if not data:
+                break
+            os.pwrite(fd, data, offset + written)
+            written += len(data)
+    finally:
+        os.close(fd)
+        if written:
+            state.sadd(upload_ranges_key(upload_id), json.dumps([offset, offset + written]))
+            record_upload('chunk', written, started)
+
+    status = upload_status(upload_id, upload)
+    advance_upload_hash(upload_id, upload, status['confirmed_offset'])
+    socketio.emit('upload_progress', status, room=request.args.get('sid'))
+    return json.dumps(dict(status, success=True)), 200
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def get_upload_status(upload_id):
+    upload, error = get_host_upload(upload_id)
+    if error:
+        return error
+    return json.dumps(dict(upload_status(upload_id, upload), success=True)), 200
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_resumable_upload(upload_id):
+    upload, error = get_host_upload(upload_id)
+    if error:
+        return error
+
+    status = upload_status(upload_id, upload)
+    if not status['complete']:
+        return json.dumps(dict(status, success=False, error='Upload is incomplete')), 409
+
+    sha256 = advance_upload_hash(upload_id, upload, upload['size']).hexdigest()
+    store_video(upload['path'], sha256, upload['size'], upload['filename'])
+    discard_resumable_upload(upload_id)
+    set_shared_video(host_room(request.args.get('sid')), sha256) # Shared in the finalizing host's room
+
+    return json.dumps({'success': True, 'video_url': video_url_for(sha256), 'sha256': sha256}), 200
+
 # Helper for secure filenames
 from werkzeug.utils import secure_filename
+from werkzeug.http import http_date
+
+load_video_index()
+recover_chat_logs()
+
+# --- Video Streaming ---
+# Range responses are streamed in fixed-size chunks (or handed to the server's zero-copy
+# sendfile path under gunicorn), so memory per viewer stays constant whatever the file size.
+VIDEO_CHUNK_SIZE = 256 * 1024
+
+def parse_byte_range(range_header, size):
+    # Returns ('ok', start, end) with an inclusive end, ('unsatisfiable', None, None),
+    # or ('ignore', None, None) for headers we answer with the whole file (as RFC 7233 allows).
+    match = re.fullmatch(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*', range_header)
+    if not match or not any(match.groups()):
+        return 'ignore', None, None # Malformed, multi-range or "bytes=-"
+    first, last = match.groups()
+
+    if not first: # Suffix range: the last N bytes
+        suffix_length = int(last)
+        if suffix_length == 0 or size == 0:
+            return 'unsatisfiable', None, None
+        return 'ok', max(0, size - suffix_length), size - 1
+
+    start = int(first)
+    end = int(last) if last else size - 1
+    if last and end < start:
+        return 'ignore', None, None
+    if start >= size:
+        return 'unsatisfiable', None, None
+    return 'ok', start, min(end, size - 1)
+
+def stream_file_chunks(f, length):
+    try:
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(VIDEO_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+# --- Shared Video Block Cache ---
+# In a watch party every viewer reads the same byte ranges at about the same time. Blocks of
+# VIDEO_CHUNK_SIZE bytes are kept in an LRU bounded by VIDEO_CACHE_BYTES, and whole blocks are
+# handed to every response as the same bytes object (only partial edge blocks are sliced).
+class VideoBlockCache:
+    def __init__(self, block_size, max_bytes):
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.blocks = OrderedDict() # (video_key, block_index) -> bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_block(self, video_key, f, index):
+        key = (video_key, index)
+        block = self.blocks.get(key)
+        if block is not None:
+            self.blocks.move_to_end(key)
+            self.hits += 1
+            return block
+
+        self.misses += 1
+        f.seek(index * self.block_size)
+        block = f.read(self.block_size)
+        if block and len(block) <= self.max_bytes:
+            self.blocks[key] = block
+            self.current_bytes += len(block)
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self.blocks.popitem(last=False)
+                self.current_bytes -= len(evicted)
+                self.evictions += 1
+        return block
+
+    def discard_video(self, video_key):
+        for key in [key for key in self.blocks if key[0] == video_key]:
+            self.current_bytes -= len(self.blocks.pop(key))
+
+    def clear(self):
+        self.blocks.clear()
+        self.current_bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'blocks': len(self.blocks),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes
+        }
+
+video_cache = VideoBlockCache(VIDEO_CHUNK_SIZE, int(os.environ.get('VIDEO_CACHE_BYTES', 64 * 1024 * 1024)))
+
+def stream_cached_chunks(f, video_key, start, length):
+    try:
+        position, end = start, start + length
+        while position < end:
+            index = position // video_cache.block_size
+            block = video_cache.get_block(video_key, f, index)
+            offset = position - index * video_cache.block_size
+            take = min(len(block) - offset, end - position)
+            if take <= 0:
+                break # File shrank underneath us
+            yield block if take == len(block) else block[offset:offset + take]
+            position += take
+    finally:
+        f.close()
+
+def file_range_body(f, start, length, video_key):
+    if video_cache.max_bytes > 0:
+        return stream_cached_chunks(f, video_key, start, length)
+    f.seek(start)
+    # Gunicorn's file_wrapper uses sendfile() and stops at Content-Length; other servers'
+    # wrappers read to EOF, so they get the chunked generator instead.
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper and request.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn'):
+        return file_wrapper(f, VIDEO_CHUNK_SIZE)
+    return stream_file_chunks(f, length)
+
+def video_validators(st):
+    # Uploaded files are never modified in place, so inode + size + mtime identify the content
+    etag = f'{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}'
+    last_modified = datetime.datetime.fromtimestamp(int(st.st_mtime), tz=datetime.timezone.utc)
+    return etag, last_modified
+
+def is_not_modified(etag, last_modified):
+    # If-None-Match takes precedence over If-Modified-Since (RFC 7232 section 6)
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return last_modified <= request.if_modified_since
+    return False
+
+def if_range_matches(etag, last_modified):
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag # Strong comparison only
+    if if_range.date is not None:
+        return if_range.date == last_modified
+    return True # No If-Range header
 
 @app.route('/videos/<filename>')
 def serve_video(filename):
@@ -1216,86 +3711,258 @@ def serve_video(filename):
     # and doesn't try to access files outside it.
     if not os.path.exists(file_path) or not os.path.commonprefix([file_path, UPLOAD_FOLDER]) == UPLOAD_FOLDER:
         return "Video not found", 404
+    if not is_stored_video(filename):
+        return "Video not found", 404
 
-    range_header = request.headers.get('Range', None)
-    if not range_header:
-        # If no range header, serve the whole file directly
-        return send_from_directory(UPLOAD_FOLDER, filename, mimetype='video/mp4')
-
-    size = os.path.getsize(file_path)
-    byte1, byte2 = 0, size - 1
+    try:
+        f = open(file_path, 'rb')
+        st = os.fstat(f.fileno())
+    except IOError:
+        return "Internal Server Error", 500
 
-    # Using a more robust regex for range parsing
-    match = re.search(r'bytes=(\d+)-(\d*)', range_header)
-    if not match:
-        return "Invalid Range header", 416 # Requested Range Not Satisfiable
+    size = st.st_size
+    etag, last_modified = video_validators(st)
+    # Video URLs are unique per upload, so caches (browser, nginx, CDN) may keep them for good
+    headers = {'ETag': f'"{etag}"', 'Last-Modified': http_date(last_modified),
+               'Cache-Control': IMMUTABLE_CACHE_CONTROL, 'Accept-Ranges': 'bytes'}
 
-    g = match.groups()
+    if is_not_modified(etag, last_modified):
+        f.close()
+        count_metric('aschat_video_responses_total', (('status', '304'),))
+        return Response(status=304, headers=headers)
 
-    if g[0]: byte1 = int(g[0])
-    if g[1]: byte2 = int(g[1]) if g[1] else size - 1
+    # A Range with a stale If-Range means the client's partial copy is outdated: send it all
+    range_header = request.headers.get('Range', None)
+    if range_header:
+        count_metric('aschat_video_range_requests_total')
+    outcome, byte1, byte2 = 'ignore', None, None
+    if range_header and if_range_matches(etag, last_modified):
+        outcome, byte1, byte2 = parse_byte_range(range_header, size)
+
+    if outcome == 'unsatisfiable':
+        f.close()
+        headers['Content-Range'] = f'bytes */{size}'
+        count_metric('aschat_video_responses_total', (('status', '416'),))
+        return Response("Requested Range Not Satisfiable", 416, headers=headers)
+
+    metadata = stored_video_metadata(filename)
+    mimetype = metadata['mime_type'] if metadata else 'video/mp4'
+
+    # Counted when the response is built; a client that disconnects early receives less
+    if outcome == 'ignore':
+        headers['Content-Length'] = str(size)
+        count_metric('aschat_video_responses_total', (('status', '200'),))
+        count_metric('aschat_video_bytes_served_total', amount=size)
+        return Response(file_range_body(f, 0, size, etag), 200, mimetype=mimetype,
+                        headers=headers, direct_passthrough=True)
 
     length = byte2 - byte1 + 1
-    
-    resp_data = None
-    try:
-        with open(file_path, 'rb') as f:
-            f.seek(byte1)
-            resp_data = f.read(length)
-    except IOError:
-        return "Internal Server Error", 500
-
-    resp = Response(resp_data, 206, mimetype='video/mp4',
-                    headers={'Content-Range': f'bytes {byte1}-{byte2}/{size}',
-                             'Accept-Ranges': 'bytes'})
+    headers['Content-Range'] = f'bytes {byte1}-{byte2}/{size}'
+    headers['Content-Length'] = str(length)
+    count_metric('aschat_video_responses_total', (('status', '206'),))
+    count_metric('aschat_video_bytes_served_total', amount=length)
+    resp = Response(file_range_body(f, byte1, length, etag), 206, mimetype=mimetype,
+                    headers=headers, direct_passthrough=True)
     return resp
 
+@app.route('/video_cache_stats')
+def video_cache_stats():
+    return json.dumps(video_cache.stats()), 200, {'Content-Type': 'application/json'}
+
 @socketio.on('host_starts_video_share')
+@metered('host_starts_video_share')
+@rate_limited('host_starts_video_share')
 def host_starts_video_share(data):
     sid = request.sid
-    if sid not in hosts:
+    room = host_room(sid)
+    if room is None:
         emit('status', {'msg': 'Permission denied: Only hosts can share video.', 'type': 'error'}, room=sid)
         return
     
     video_url = data.get('video_url', '')
     if video_url:
-        emit('start_video_playback', {'video_url': video_url}, room=CHAT_ROOM)
-        emit('status', {'msg': f'Host is sharing a video!', 'type': 'system'}, room=CHAT_ROOM)
-        print(f"Host {sid} starting video share: {video_url}")
+        reset_playback_state(room) # The host's next control (which carries 'playing') sets the real state
+        broadcast('start_video_playback', {'video_url': video_url}, room=room.chat_room)
+        broadcast('status', {'msg': f'Host is sharing a video!', 'type': 'system'}, room=room.chat_room)
+        log_event('video_share_started', sid=sid, room=room.id, video_url=video_url)
     else:
         emit('status', {'msg': 'No video URL provided for sharing.', 'type': 'error'}, room=sid)
 
 @socketio.on('host_clears_video')
+@metered('host_clears_video')
+@rate_limited('host_clears_video')
 def host_clears_video():
     sid = request.sid
-    if sid not in hosts:
+    room = host_room(sid)
+    if room is None:
         emit('status', {'msg': 'Permission denied: Only hosts can clear video.', 'type': 'error'}, room=sid)
         return
     
-    global current_shared_video_server_path
-    current_shared_video_server_path = None
-    
-    # Safely clear the upload directory contents
-    if os.path.exists(UPLOAD_FOLDER):
-        for item in os.listdir(UPLOAD_FOLDER):
-            item_path = os.path.join(UPLOAD_FOLDER, item)
-            try:
-                if os.path.isfile(item_path) or os.path.islink(item_path):
-                    os.unlink(item_path)
-                elif os.path.isdir(item_path):
-                    shutil.rmtree(item_path)
-            except Exception as e:
-                print(f'Failed to delete {item_path}. Reason: {e}')
+    set_shared_video(room, None) # The file stays in the store so sharing it again is instant
+    reset_playback_state(room)
+    # set_shared_video drops the video's cached blocks once no room shares it any more
 
-    emit('clear_video_playback', room=CHAT_ROOM)
-    emit('status', {'msg': f'Host has stopped sharing the video.', 'type': 'system'}, room=CHAT_ROOM)
+    broadcast('clear_video_playback', room=room.chat_room)
+    broadcast('status', {'msg': f'Host has stopped sharing the video.', 'type': 'system'}, room=room.chat_room)
 
 @socketio.on('host_video_control')
+@metered('host_video_control')
+@rate_limited('host_video_control')
 def host_video_control(data):
     sid = request.sid
-    if sid not in hosts:
+    room = host_room(sid)
+    if room is None:
+        return
+    if not isinstance(data, dict):
+        broadcast('sync_video_playback', data, room=room.chat_room, include_self=False)
         return
-    emit('sync_video_playback', data, room=CHAT_ROOM, include_self=False)
+    position = data.get('time')
+    log_event('video_control', sid=sid, room=room.id, action=data.get('action'), position=position)
+    if data.get('action') in ('play', 'pause', 'seek') and isinstance(position, (int, float)):
+        playback_state = update_playback_state(room, data['action'], position, data.get('rate'), data.get('sent_at'), data.get('playing'))
+        broadcast('sync_video_playback', playback_sync_payload(playback_state, data['action']), room=room.chat_room, include_self=False)
+    else:
+        broadcast('sync_video_playback', data, room=room.chat_room, include_self=False)
+
+@socketio.on('clock_sync')
+@metered('clock_sync')
+@rate_limited('clock_sync')
+def clock_sync(data=None):
+    # Acknowledged with the server clock so clients can estimate their offset NTP-style
+    return {'server_time': time.time()}
+
+@app.route('/metrics')
+def metrics():
+    room_ids = list(state.hgetall('rooms'))
+    rooms = [get_room(room_id) for room_id in room_ids]
+    gauges = [
+        ('aschat_rooms', 'Rooms in the registry', len(room_ids)),
+        ('aschat_connected_users', 'Connected users across all rooms', sum(len(room.user_info) for room in rooms)),
+        ('aschat_hosts', 'Authenticated hosts across all rooms', sum(len(room.hosts) for room in rooms)),
+        ('aschat_muted_users', 'Individually muted users across all rooms', sum(len(room.muted_users) for room in rooms)),
+    ]
+    return render_metrics(gauges), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# --- Profiling ---
+# A host can sample the live worker for up to MAX_PROFILE_SECONDS. The sampler runs on a
+# real OS thread (not a green one), so it sees whatever the event loop is executing,
+# and records the Python stack of the main thread every PROFILE_SAMPLE_INTERVAL.
+# Results are downloadable as collapsed stacks (for flamegraph.pl / speedscope) or as a
+# pstats file built from the samples (times are sample counts x interval).
+
+PROFILE_SAMPLE_INTERVAL = 0.005 # Seconds
+MAX_PROFILE_SECONDS = 60
+PROFILES_KEPT = 3
+
+profiles = OrderedDict() # profile_id -> {'samples', 'seconds', 'interval', 'done'}
+active_profile_id = None
+
+def sample_stacks(profile):
+    # Only the main thread, where the event loop runs every green thread; other OS threads
+    # (the log writer) mostly sleep and would fill the profile with idle stacks
+    main_ident = real_threading.main_thread().ident
+    samples = profile['samples']
+    deadline = real_time.monotonic() + profile['seconds']
+    while real_time.monotonic() < deadline:
+        frame = sys._current_frames().get(main_ident)
+        if frame is not None:
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            stack = tuple(reversed(stack))
+            samples[stack] = samples.get(stack, 0) + 1
+        real_time.sleep(profile['interval'])
+    profile['done'] = True
+
+def finish_profile(profile_id, sid):
+    global active_profile_id
+    profile = profiles[profile_id]
+    while not profile['done']:
+        socketio.sleep(0.5)
+    active_profile_id = None
+    base_url = f'/profiles/{profile_id}?sid={sid}'
+    socketio.emit('profile_ready', {
+        'profile_id': profile_id,
+        'collapsed_url': base_url + '&format=collapsed',
+        'pstats_url': base_url + '&format=pstats'
+    }, room=sid)
+
+def frame_label(func):
+    filename, line, name = func
+    return f'{name} ({os.path.basename(filename)}:{line})'
+
+def collapsed_stacks(profile):
+    lines = [';'.join(frame_label(func) for func in stack) + f' {count}'
+             for stack, count in profile['samples'].items()]
+    return '\n'.join(sorted(lines)) + '\n'
+
+def profile_pstats(profile):
+    # pstats' on-disk format: a marshalled {func: (cc, nc, tt, ct, {caller: (cc, nc, tt, ct)})}
+    interval = profile['interval']
+    stats = {}
+    for stack, count in profile['samples'].items():
+        seconds = count * interval
+        seen = set()
+        for depth, func in enumerate(stack):
+            entry = stats.setdefault(func, [0, 0, 0.0, 0.0, {}])
+            leaf = depth == len(stack) - 1
+            if leaf:
+                entry[2] += seconds
+            if func in seen: # Recursion: count each stack once per function
+                continue
+            seen.add(func)
+            entry[0] += count
+            entry[1] += count
+            entry[3] += seconds
+            if depth:
+                caller = stack[depth - 1]
+                cc, nc, tt, ct = entry[4].get(caller, (0, 0, 0.0, 0.0))
+                entry[4][caller] = (cc + count, nc + count, tt + (seconds if leaf else 0.0), ct + seconds)
+    return marshal.dumps({func: tuple(entry) for func, entry in stats.items()})
+
+@socketio.on('start_profile')
+@metered('start_profile')
+@rate_limited('start_profile')
+def start_profile(data=None):
+    global active_profile_id
+    sid = request.sid
+    if host_room(sid) is None:
+        return {'success': False, 'error': 'Permission denied: Only hosts can profile the server.'}
+    if active_profile_id is not None:
+        return {'success': False, 'error': 'A profile is already running.'}
+    seconds = (data or {}).get('seconds', 10)
+    if not isinstance(seconds, (int, float)) or seconds <= 0:
+        return {'success': False, 'error': 'seconds must be a positive number.'}
+    seconds = min(float(seconds), MAX_PROFILE_SECONDS)
+
+    profile_id = secrets.token_hex(8)
+    profiles[profile_id] = {'samples': {}, 'seconds': seconds, 'interval': PROFILE_SAMPLE_INTERVAL, 'done': False}
+    while len(profiles) > PROFILES_KEPT:
+        profiles.popitem(last=False)
+    active_profile_id = profile_id
+    real_threading.Thread(target=sample_stacks, args=(profiles[profile_id],), daemon=True).start()
+    socketio.start_background_task(finish_profile, profile_id, sid)
+    log_event('profile_started', sid=sid, profile_id=profile_id, seconds=seconds)
+    return {'success': True, 'profile_id': profile_id, 'seconds': seconds}
+
+@app.route('/profiles/<profile_id>')
+def download_profile(profile_id):
+    if host_room(request.args.get('sid')) is None:
+        return json.dumps({'success': False, 'error': 'Permission denied: Not a host'}), 403
+    profile = profiles.get(profile_id)
+    if profile is None or not profile['done']:
+        return json.dumps({'success': False, 'error': 'Unknown or unfinished profile'}), 404
+    if request.args.get('format') == 'pstats':
+        return Response(profile_pstats(profile), mimetype='application/octet-stream', headers={
+            'Content-Disposition': f'attachment; filename=aschat-{profile_id}.pstats'})
+    return Response(collapsed_stacks(profile), mimetype='text/plain', headers={
+        'Content-Disposition': f'attachment; filename=aschat-{profile_id}.collapsed.txt'})
+
+# Every Flask view gets the same timing and slow-event hooks as the Socket.IO handlers
+for endpoint, view in list(app.view_functions.items()):
+    app.view_functions[endpoint] = profiled_route(endpoint)(view)
 
 if __name__ == '__main__':
     # For production, you should use a production-ready WSGI server like Gunicorn
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# main.py creates its upload and chat log folders at import time; keep them out of the repo
+os.environ.setdefault('DATA_DIR', tempfile.mkdtemp(prefix='aschat-tests-'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,29 @@
+import pytest
+
+import main
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-99', ('ok', 0, 99)),
+    ('bytes=100-', ('ok', 100, 999)),
+    ('bytes=900-5000', ('ok', 900, 999)), # End past the file is clamped
+    (' bytes = 10 - 20 ', ('ok', 10, 20)),
+    # Suffix ranges: the last N bytes
+    ('bytes=-100', ('ok', 900, 999)),
+    ('bytes=-5000', ('ok', 0, 999)),
+    ('bytes=-0', ('unsatisfiable', None, None)),
+    # Out of range
+    ('bytes=1000-', ('unsatisfiable', None, None)),
+    ('bytes=1000-1100', ('unsatisfiable', None, None)),
+    # Answered with the whole file
+    ('bytes=0-1,5-6', ('ignore', None, None)),
+    ('bytes=-', ('ignore', None, None)),
+    ('bytes=50-10', ('ignore', None, None)),
+    ('items=0-10', ('ignore', None, None)),
+    ('bytes=abc', ('ignore', None, None)),
+])
+def test_parse_byte_range(header, expected):
+    assert main.parse_byte_range(header, 1000) == expected
+
+def test_suffix_range_of_empty_file_is_unsatisfiable():
+    assert main.parse_byte_range('bytes=-10', 0) == ('unsatisfiable', None, None)
+    assert main.parse_byte_range('bytes=0-', 0) == ('unsatisfiable', None, None)
@@ -0,0 +1,109 @@
+import os
+
+import main
+
+def fill_log(folder, count):
+    log = main.ChatLog(str(folder))
+    for message_id in range(1, count + 1):
+        log.append(message_id, 1000.0 + message_id, 'user', f'message {message_id}')
+    log.sync()
+    return log
+
+def segment_paths(folder):
+    # The single writer's partition
+    names = sorted(os.listdir(folder / 'w0'))
+    return [folder / 'w0' / name for name in names if name.endswith('.log')], [folder / 'w0' / name for name in names if name.endswith('.idx')]
+
+def all_pages(log, limit=40):
+    seen = []
+    before = None
+    while True:
+        page = log.read_page(before=before, limit=limit)
+        if not page:
+            return seen
+        seen = page + seen
+        before = page[0]['id']
+
+def test_torn_tail_and_missing_index_are_recovered(tmp_path):
+    count = main.CHAT_LOG_INDEX_INTERVAL * 3 + 10
+    fill_log(tmp_path, count).close()
+    (log_path,), (index_path,) = segment_paths(tmp_path)
+    # Crash mid-write: half of the last record made it to disk and the index never did
+    os.truncate(log_path, os.path.getsize(log_path) - 5)
+    os.remove(index_path)
+
+    log = main.ChatLog(str(tmp_path))
+    log.append(count, 2000.0, 'user', 'after the crash') # Adopting the partition repairs it
+    log.sync()
+
+    assert log.last_id == count
+    messages = log.read_page(limit=main.MAX_HISTORY_PAGE_SIZE)
+    assert [m['id'] for m in messages] == list(range(count - main.MAX_HISTORY_PAGE_SIZE + 1, count + 1))
+    assert messages[-2] == {'id': count - 1, 'time': 1000.0 + count - 1, 'username': 'user', 'message': f'message {count - 1}'}
+    assert messages[-1]['message'] == 'after the crash'
+    # The torn record is gone from disk and the index was rebuilt
+    assert os.path.getsize(log_path) == log.writer.segments[0].size
+    assert index_path.exists()
+    assert [entry[0] for entry in log.writer.segments[0].index] == [1 + main.CHAT_LOG_INDEX_INTERVAL * n for n in range(4)]
+
+def test_readers_do_not_repair_a_partition_they_do_not_own(tmp_path):
+    writer = fill_log(tmp_path, 100)
+    (log_path,), _ = segment_paths(tmp_path)
+    size = os.path.getsize(log_path)
+    with open(log_path, 'ab') as f:
+        f.write(main.CHAT_LOG_RECORD_HEADER.pack(50, 101) + b'[') # The owner is mid-write
+
+    reader = main.ChatLog(str(tmp_path))
+
+    assert reader.last_id == 100
+    assert [m['id'] for m in reader.read_page(limit=3)] == [98, 99, 100]
+    assert os.path.getsize(log_path) == size + main.CHAT_LOG_RECORD_HEADER.size + 1
+    writer.close()
+
+def test_paging_across_segments(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'CHAT_LOG_SEGMENT_BYTES', 2000)
+    log = fill_log(tmp_path, 300)
+    assert len(log.writer.segments) > 1
+
+    assert [m['id'] for m in all_pages(log)] == list(range(1, 301))
+    log.close()
+
+def test_two_writers_share_one_room(tmp_path, monkeypatch):
+    # Two workers serving the same room, each with its own ChatLog for the folder
+    monkeypatch.setattr(main, 'CHAT_LOG_SEGMENT_BYTES', 3000)
+    first, second = main.ChatLog(str(tmp_path)), main.ChatLog(str(tmp_path))
+    for message_id in range(1, 1001):
+        writer = first if message_id % 2 else second
+        writer.append(message_id, 1000.0 + message_id, 'user', f'message {message_id}')
+        if message_id % 7 == 0:
+            writer.flush()
+    first.sync()
+    second.sync()
+    assert first.writer.folder != second.writer.folder
+
+    for log in (first, second, main.ChatLog(str(tmp_path))):
+        assert [m['id'] for m in all_pages(log)] == list(range(1, 1001))
+        assert log.last_id == 1000
+
+    # After a restart the partitions are adopted again instead of new ones being made
+    first.close()
+    second.close()
+    restarted = main.ChatLog(str(tmp_path))
+    restarted.append(1001, 3000.0, 'user', 'after the restart')
+    assert sorted(os.listdir(tmp_path)) == ['w0', 'w1']
+    assert [m['id'] for m in restarted.read_page(limit=2)] == [1000, 1001]
+    restarted.close()
+
+def test_history_survives_a_corrupt_record(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'CHAT_LOG_FOLDER', str(tmp_path))
+    monkeypatch.setattr(main, 'chat_logs', {})
+    fill_log(tmp_path / 'corrupt', 10).close()
+    (log_path,), _ = segment_paths(tmp_path / 'corrupt')
+    data = bytearray(log_path.read_bytes())
+    data[main.CHAT_LOG_RECORD_HEADER.size] = ord('{') # The first payload is no longer a JSON list
+    log_path.write_bytes(bytes(data))
+
+    response = main.app.test_client().get('/history?room=corrupt')
+
+    assert response.status_code == 200
+    assert response.get_json()['messages'] == []
@@ -0,0 +1,100 @@
+import struct
+
+import main
+
+def box(box_type, payload):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+def chunk_offset_box(box_type, offsets):
+    code = 'I' if box_type == b'stco' else 'Q'
+    return box(box_type, b'\0\0\0\0' + struct.pack(f'>I{len(offsets)}{code}', len(offsets), *offsets))
+
+def moov_with(offset_box):
+    return box(b'moov', box(b'trak', box(b'mdia', box(b'minf', box(b'stbl', offset_box)))))
+
+FTYP = box(b'ftyp', b'isom\0\0\0\0isom')
+MEDIA = bytes(range(256)) * 4
+MDAT = box(b'mdat', MEDIA)
+MEDIA_START = len(FTYP) + 8
+
+def read_chunk_offsets(path, box_type):
+    with open(path, 'rb') as f:
+        size = f.seek(0, 2)
+        start, end = main.find_mp4_box(f, 0, size, [b'moov', b'trak', b'mdia', b'minf', b'stbl', box_type])
+        f.seek(start + 4)
+        count = struct.unpack('>I', f.read(4))[0]
+        code = 'I' if box_type == b'stco' else 'Q'
+        return list(struct.unpack(f'>{count}{code}', f.read(count * struct.calcsize(code))))
+
+def chunks_at(path, offsets, length=16):
+    with open(path, 'rb') as f:
+        data = f.read()
+    return [data[offset:offset + length] for offset in offsets]
+
+def test_moov_moves_in_front_of_mdat_and_stco_is_shifted(tmp_path):
+    offsets = [MEDIA_START, MEDIA_START + 100, MEDIA_START + 700]
+    moov = moov_with(chunk_offset_box(b'stco', offsets))
+    src, dst = tmp_path / 'src.mp4', tmp_path / 'dst.mp4'
+    src.write_bytes(FTYP + MDAT + moov)
+
+    assert main.mp4_faststart(str(src), str(dst))
+
+    output = dst.read_bytes()
+    assert len(output) == len(FTYP) + len(MDAT) + len(moov)
+    assert output[len(FTYP) + 4:len(FTYP) + 8] == b'moov'
+    assert output[len(FTYP) + len(moov):] == MDAT
+    shifted = read_chunk_offsets(dst, b'stco')
+    assert shifted == [offset + len(moov) for offset in offsets]
+    # Every chunk offset still points at the same media bytes
+    assert chunks_at(dst, shifted) == chunks_at(src, offsets)
+
+def test_co64_offsets_are_shifted(tmp_path):
+    offsets = [MEDIA_START, MEDIA_START + 512]
+    moov = moov_with(chunk_offset_box(b'co64', offsets))
+    src, dst = tmp_path / 'src.mp4', tmp_path / 'dst.mp4'
+    src.write_bytes(FTYP + MDAT + moov)
+
+    assert main.mp4_faststart(str(src), str(dst))
+
+    shifted = read_chunk_offsets(dst, b'co64')
+    assert shifted == [offset + len(moov) for offset in offsets]
+    assert chunks_at(dst, shifted) == chunks_at(src, offsets)
+
+def test_offsets_before_mdat_are_left_alone(tmp_path):
+    offsets = [4, MEDIA_START] # The first one points into ftyp, which does not move
+    moov = moov_with(chunk_offset_box(b'stco', offsets))
+    src, dst = tmp_path / 'src.mp4', tmp_path / 'dst.mp4'
+    src.write_bytes(FTYP + MDAT + moov)
+
+    assert main.mp4_faststart(str(src), str(dst))
+
+    assert read_chunk_offsets(dst, b'stco') == [4, MEDIA_START + len(moov)]
+
+def test_already_faststart_file_is_skipped(tmp_path):
+    src, dst = tmp_path / 'src.mp4', tmp_path / 'dst.mp4'
+    src.write_bytes(FTYP + moov_with(chunk_offset_box(b'stco', [0])) + MDAT)
+
+    assert not main.mp4_faststart(str(src), str(dst))
+    assert not dst.exists()
+
+def test_non_mp4_is_skipped(tmp_path):
+    src, dst = tmp_path / 'src.webm', tmp_path / 'dst.webm'
+    src.write_bytes(b'\x1a\x45\xdf\xa3' + bytes(100))
+
+    assert not main.mp4_faststart(str(src), str(dst))
+    assert not dst.exists()
+
+def test_stco_overflow_is_skipped(tmp_path):
+    # A sparse file just past 4 GiB: shifting an offset near the end of the mdat would no
+    # longer fit in 32 bits, so the file must be left as it is rather than corrupted
+    mdat_size = 2 ** 32
+    moov = moov_with(chunk_offset_box(b'stco', [0xFFFFFFF0]))
+    src, dst = tmp_path / 'src.mp4', tmp_path / 'dst.mp4'
+    with open(src, 'wb') as f:
+        f.write(FTYP)
+        f.write(struct.pack('>I4sQ', 1, b'mdat', mdat_size))
+        f.seek(len(FTYP) + mdat_size)
+        f.write(moov)
+
+    assert not main.mp4_faststart(str(src), str(dst))
+    assert not dst.exists()
@@ -0,0 +1,125 @@
+import struct
+
+import pytest
+
+import main
+
+def box(box_type, payload):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+def mvhd(version, timescale, duration):
+    if version == 1:
+        return box(b'mvhd', b'\1\0\0\0' + bytes(16) + struct.pack('>IQ', timescale, duration) + bytes(80))
+    return box(b'mvhd', bytes(4) + bytes(8) + struct.pack('>II', timescale, duration) + bytes(80))
+
+def tkhd(version, width, height):
+    prefix = b'\1\0\0\0' + bytes(84) if version == 1 else bytes(76)
+    return box(b'tkhd', prefix + struct.pack('>II', width << 16, height << 16))
+
+def trak(handler, codec, header=b''):
+    media = b''
+    if handler:
+        media += box(b'hdlr', bytes(8) + handler + bytes(12) + b'name\0')
+    stsd = box(b'stsd', bytes(4) + struct.pack('>II', 1, 16) + codec + bytes(8))
+    return box(b'trak', header + box(b'mdia', media + box(b'minf', box(b'stbl', stsd))))
+
+def write_mp4(path, *boxes, brand=b'isom'):
+    path.write_bytes(box(b'ftyp', brand + bytes(4) + brand) + b''.join(boxes) + box(b'mdat', bytes(64)))
+    return str(path)
+
+@pytest.mark.parametrize('version', [0, 1])
+def test_mp4_duration_dimensions_and_codecs(tmp_path, version):
+    moov = box(b'moov', mvhd(version, 1000, 12500)
+               + trak(b'vide', b'avc1', tkhd(version, 1920, 1080))
+               + trak(b'soun', b'mp4a'))
+    metadata = main.extract_video_metadata(write_mp4(tmp_path / 'a.mp4', moov), 'a.mp4')
+
+    assert metadata['container'] == 'mp4'
+    assert metadata['mime_type'] == 'video/mp4'
+    assert metadata['duration'] == 12.5
+    assert (metadata['width'], metadata['height']) == (1920, 1080)
+    assert metadata['tracks'] == [
+        {'type': 'video', 'codec': 'avc1', 'width': 1920, 'height': 1080},
+        {'type': 'audio', 'codec': 'mp4a'},
+    ]
+    assert metadata['bitrate'] == int((tmp_path / 'a.mp4').stat().st_size * 8 / 12.5)
+
+def test_quicktime_brand(tmp_path):
+    moov = box(b'moov', mvhd(0, 600, 600) + trak(b'vide', b'avc1', tkhd(0, 640, 480)))
+    metadata = main.extract_video_metadata(write_mp4(tmp_path / 'a.mov', moov, brand=b'qt  '), 'a.mov')
+    assert metadata['container'] == 'quicktime'
+    assert metadata['mime_type'] == 'video/quicktime'
+
+@pytest.mark.parametrize('tracks, mime_type', [
+    ([trak(b'soun', b'mp4a')], 'audio/mp4'),
+    ([trak(None, b'avc1')], 'video/mp4'), # No hdlr: the track type is unknown
+    ([trak(b'text', b'tx3g')], 'video/mp4'),
+    ([trak(b'soun', b'mp4a'), trak(b'sbtl', b'tx3g')], 'video/mp4'),
+    ([], 'video/mp4'),
+])
+def test_mp4_mime_type_is_audio_only_when_every_track_is_audio(tmp_path, tracks, mime_type):
+    moov = box(b'moov', mvhd(0, 1000, 1000) + b''.join(tracks))
+    metadata = main.extract_video_metadata(write_mp4(tmp_path / 'a.mp4', moov), 'a.mp4')
+    assert metadata['mime_type'] == mime_type
+
+def test_mp4_without_moov(tmp_path):
+    metadata = main.extract_video_metadata(write_mp4(tmp_path / 'a.mp4'), 'a.mp4')
+    assert metadata['container'] == 'mp4'
+    assert metadata['tracks'] == [] and metadata['duration'] is None
+
+def ebml(element_id, data):
+    if isinstance(data, int):
+        data = data.to_bytes(max(1, (data.bit_length() + 7) // 8), 'big')
+    elif isinstance(data, str):
+        data = data.encode('ascii')
+    id_bytes = element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big')
+    return id_bytes + b'\x01' + len(data).to_bytes(7, 'big') + data # 8-byte size vint
+
+def track_entry(track_type, codec, width=None, height=None):
+    children = ebml(main.MKV_TRACK_TYPE_ID, track_type) + ebml(main.MKV_CODEC_ID, codec)
+    if width:
+        children += ebml(main.MKV_VIDEO_ID, ebml(main.MKV_PIXEL_WIDTH_ID, width) + ebml(main.MKV_PIXEL_HEIGHT_ID, height))
+    return ebml(main.MKV_TRACK_ENTRY_ID, children)
+
+def write_matroska(path, doctype, *entries):
+    info = ebml(main.MKV_INFO_ID, ebml(main.MKV_TIMECODE_SCALE_ID, 1000000) + ebml(main.MKV_DURATION_ID, struct.pack('>d', 3500.0)))
+    segment = info + ebml(main.MKV_TRACKS_ID, b''.join(entries)) + ebml(main.MKV_CLUSTER_ID, bytes(32))
+    path.write_bytes(ebml(main.EBML_HEADER_ID, ebml(main.EBML_DOCTYPE_ID, doctype)) + ebml(main.MKV_SEGMENT_ID, segment))
+    return str(path)
+
+def test_webm_doctype_tracks_and_info(tmp_path):
+    path = write_matroska(tmp_path / 'a.webm', 'webm', track_entry(1, 'V_VP9', 1280, 720), track_entry(2, 'A_OPUS'))
+    metadata = main.extract_video_metadata(path, 'a.webm')
+
+    assert metadata['container'] == 'webm'
+    assert metadata['mime_type'] == 'video/webm'
+    assert metadata['duration'] == 3.5
+    assert (metadata['width'], metadata['height']) == (1280, 720)
+    assert metadata['tracks'] == [
+        {'type': 'video', 'codec': 'V_VP9', 'width': 1280, 'height': 720},
+        {'type': 'audio', 'codec': 'A_OPUS'},
+    ]
+
+def test_matroska_audio_only(tmp_path):
+    path = write_matroska(tmp_path / 'a.mka', 'matroska', track_entry(2, 'A_FLAC'))
+    metadata = main.extract_video_metadata(path, 'a.mka')
+    assert metadata['container'] == 'matroska'
+    assert metadata['mime_type'] == 'audio/x-matroska'
+
+@pytest.mark.parametrize('name', ['a.mp4', 'a.webm'])
+def test_truncated_file_falls_back_to_the_file_name(tmp_path, name):
+    if name.endswith('.mp4'):
+        moov = box(b'moov', mvhd(0, 1000, 1000) + trak(b'vide', b'avc1', tkhd(0, 640, 480)))
+        path = write_mp4(tmp_path / name, moov)
+        cut = 40 # Inside moov
+    else:
+        path = write_matroska(tmp_path / name, 'webm', track_entry(1, 'V_VP8', 640, 480))
+        cut = 60 # Inside the segment's Info element
+    with open(path, 'r+b') as f:
+        f.truncate(cut)
+
+    metadata = main.extract_video_metadata(path, name)
+
+    assert metadata['container'] is None
+    assert metadata['mime_type'] == ('video/mp4' if name.endswith('.mp4') else 'video/webm')
+    assert metadata['duration'] is None and metadata['width'] is None
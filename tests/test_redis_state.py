@@ -0,0 +1,73 @@
+import fakeredis
+import pytest
+
+import main
+
+@pytest.fixture
+def redis_state(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(main, 'state', main.RedisStateBackend(client))
+    monkeypatch.setattr(main, 'room_views', {})
+    monkeypatch.setattr(main, 'HOST_PASSWORD', 'test-password')
+    return client
+
+def keys(client):
+    return {key.decode('utf-8') for key in client.keys('*')}
+
+def test_backend_round_trips_values(redis_state):
+    state = main.state
+    assert state.incr('counter') == 1
+    assert state.incr('counter') == 2
+    state.set('flag', {'a': [1, 2]})
+    assert state.get('flag') == {'a': [1, 2]}
+    assert state.get('missing', 'default') == 'default'
+
+    state.hset('hash', 'sid', {'username': 'ann'})
+    assert state.hget('hash', 'sid') == {'username': 'ann'}
+    assert state.hexists('hash', 'sid') and state.hlen('hash') == 1
+    assert state.hgetall('hash') == {'sid': {'username': 'ann'}}
+    assert state.hdel('hash', 'sid') and not state.hexists('hash', 'sid')
+
+    state.sadd('set', 'x')
+    assert state.sismember('set', 'x') and state.smembers('set') == {'x'} and state.scard('set') == 1
+    state.srem('set', 'x')
+    assert not state.sismember('set', 'x')
+
+def test_rpush_capped_keeps_the_newest(redis_state):
+    for n in range(10):
+        main.state.rpush_capped('list', [n], 3)
+    assert main.state.lrange('list') == [[7], [8], [9]]
+    main.state.delete('list')
+    assert main.state.lrange('list') == []
+
+def test_room_state_lives_in_redis_and_is_collected(redis_state, monkeypatch):
+    monkeypatch.setattr(main, 'CHAT_HISTORY_SIZE', 3)
+    host = main.socketio.test_client(main.app, query_string='room=redis-room')
+    viewer = main.socketio.test_client(main.app, query_string='room=redis-room')
+    host.emit('authenticate_host', {'password': 'test-password'})
+    room = main.get_room('redis-room')
+    host_sid, viewer_sid = sorted(room.user_info.snapshot(), key=lambda sid: sid not in room.hosts)
+
+    assert host_sid in room.hosts and viewer_sid not in room.hosts
+    assert room.user_info[host_sid]['is_host']
+    assert main.host_room(host_sid) is room and main.host_room(viewer_sid) is None
+    assert redis_state.sismember('aschat:room:redis-room:hosts', host_sid)
+
+    host.emit('toggle_mute_user', {'target_sid': viewer_sid})
+    assert viewer_sid in room.muted_users and room.user_info[viewer_sid]['is_muted']
+
+    for n in range(5):
+        host.emit('message', {'username': 'host', 'message': f'message {n}'})
+    assert room.get('message_seq') == 5
+    messages, complete, reset = main.chat_history(room)
+    assert [m['id'] for m in messages] == [3, 4, 5] and not complete and not reset
+
+    host.disconnect()
+    viewer.disconnect()
+    assert len(room.user_info) == 0
+    assert main.state.hget('rooms', 'redis-room')['empty_since'] is not None
+
+    monkeypatch.setattr(main, 'ROOM_TTL', 0)
+    main.collect_idle_rooms()
+    assert not main.state.hexists('rooms', 'redis-room')
+    assert not [key for key in keys(redis_state) if key.startswith('aschat:room:redis-room:')]